@@ -0,0 +1,92 @@
+from datetime import datetime, timedelta
+import random
+
+
+BUILDING_ID = 92
+BUILDING = "Таллинская ул., д.34"
+
+LESSON_TIMES = [
+    ("09:30", "10:50"),
+    ("11:10", "12:30"),
+    ("13:00", "14:20"),
+    ("14:40", "16:00"),
+    ("16:20", "17:40"),
+    ("18:10", "19:30"),
+]
+KINDS_OF_WORK = ["Лекция", "Семинар", "Практическое занятие", "Лабораторная работа"]
+
+# Users that "create" events in the fake calendar, records are saved for them
+CREATOR_EMAIL = "calendar-bot@miem.hse.ru"
+
+
+class Dataset:
+    """
+    Generated schedule of a building, the same arguments always give the same data
+    rooms - number of auditoriums, lessons_per_room - lessons of every room in the period,
+    online_ratio - part of lessons with a Jitsi link
+    """
+
+    def __init__(
+        self,
+        rooms: int = 20,
+        lessons_per_room: int = 30,
+        period: int = 14,
+        streams: int = 40,
+        online_ratio: float = 0.2,
+        seed: int = 0,
+    ):
+        self.random = random.Random(seed)
+        self.period = period
+        self.auditoriums = [
+            {
+                "auditoriumOid": 10000 + index,
+                "number": f"{500 + index}",
+                "buildingGid": BUILDING_ID,
+                "building": BUILDING,
+                "typeOfAuditorium": "Лекционная аудитория",
+            }
+            for index in range(rooms)
+        ]
+        self.streams = {
+            f"БИВ{index:03d}": [f"biv{index:03d}-{group}@edu.hse.ru" for group in range(3)]
+            for index in range(streams)
+        }
+        self.next_lesson_oid = 1000000
+        self.classes = [
+            self.make_class(auditorium, online_ratio)
+            for auditorium in self.auditoriums
+            for _ in range(lessons_per_room)
+        ]
+
+    def make_class(self, auditorium: dict, online_ratio: float) -> dict:
+        self.next_lesson_oid += 1
+        date = datetime.today() + timedelta(days=self.random.randint(0, self.period))
+        begin, end = self.random.choice(LESSON_TIMES)
+        stream = self.random.choice(list(self.streams))
+        lecturer = self.random.randint(1, 200)
+        online = self.random.random() < online_ratio
+
+        return {
+            "auditorium": auditorium["number"],
+            "auditoriumOid": auditorium["auditoriumOid"],
+            "beginLesson": begin,
+            "building": auditorium["building"],
+            "date": date.strftime("%Y.%m.%d"),
+            "discipline": f"Дисциплина {self.random.randint(1, 300)} (рус)",
+            "endLesson": end,
+            "group": f"{stream}#{self.random.randint(1, 3)}",
+            "kindOfWork": self.random.choice(KINDS_OF_WORK),
+            "lecturer": f"Преподаватель {lecturer}",
+            "lecturerEmail": f"lecturer{lecturer}@hse.ru",
+            "lessonOid": self.next_lesson_oid,
+            "url1": f"https://meet.miem.hse.ru/{self.next_lesson_oid}" if online else None,
+        }
+
+    def churn(self, ratio: float) -> int:
+        """ Changes time of a part of lessons, as if the schedule was edited, returns how many were changed """
+
+        changed = self.random.sample(self.classes, int(len(self.classes) * ratio))
+        for class_ in changed:
+            class_["beginLesson"], class_["endLesson"] = self.random.choice(LESSON_TIMES)
+            class_["discipline"] += " *"
+        return len(changed)
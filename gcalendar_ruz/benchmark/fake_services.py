@@ -0,0 +1,404 @@
+"""
+Local stand-ins for RUZ, Erudite and Google Calendar, used by the benchmark
+
+Every service has the same control endpoints:
+    GET /_stats - counts of handled requests by route and status
+    POST /_churn?ratio=0.1 - (RUZ only) changes a part of the schedule
+
+Run standalone: python -m benchmark.fake_services --rooms 50 --lessons 40
+"""
+
+from collections import Counter
+from urllib.parse import unquote
+from uuid import uuid4
+import argparse
+import asyncio
+import json
+import random
+import re
+import time
+
+from aiohttp import web
+
+from .datasets import Dataset, CREATOR_EMAIL
+
+
+RUZ_PORT = 18081
+ERUDITE_PORT = 18082
+GOOGLE_PORT = 18083
+
+EVENT_PATH = re.compile(r"^/calendar/v3/calendars/([^/]+)/events(?:/([^/]+))?$")
+
+
+class Faults:
+    """
+    Makes a service slow and unreliable
+    latency, jitter - seconds added to every request, rate - requests per second before the service
+    starts to refuse them, error_rate - part of requests that fail
+    """
+
+    def __init__(
+        self, latency: float = 0.0, jitter: float = 0.0, rate: float = None, error_rate: float = 0.0, seed: int = 0
+    ):
+        self.latency = latency
+        self.jitter = jitter
+        self.rate = rate
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.tokens = rate or 0
+        self.updated_at = time.monotonic()
+
+    async def delay(self):
+        seconds = self.latency + self.random.uniform(0, self.jitter)
+        if seconds > 0:
+            await asyncio.sleep(seconds)
+
+    def limited(self) -> bool:
+        """ True if the request is over the rate limit """
+
+        if self.rate is None:
+            return False
+
+        now = time.monotonic()
+        self.tokens = min(self.rate, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+        if self.tokens < 1:
+            return True
+        self.tokens -= 1
+        return False
+
+    def failed(self) -> bool:
+        return self.random.random() < self.error_rate
+
+
+class FakeService:
+    """
+    Base of fake services: counting of requests, delays and injected errors
+    Subclasses add their routes in add_routes(router)
+    """
+
+    name = ""
+
+    def __init__(self, faults: Faults):
+        self.faults = faults
+        self.stats = Counter()
+
+    def app(self) -> web.Application:
+        app = web.Application(middlewares=[self.middleware], client_max_size=64 * 1024 * 1024)
+        app.router.add_get("/_stats", self.handle_stats)
+        self.add_routes(app.router)
+        return app
+
+    def error(self, status: int, reason: str) -> web.Response:
+        return web.json_response({"message": reason}, status=status)
+
+    @web.middleware
+    async def middleware(self, request, handler):
+        if request.path.startswith("/_"):
+            return await handler(request)
+
+        await self.faults.delay()
+        if self.faults.limited():
+            response = self.error(429, "rateLimitExceeded")
+        elif self.faults.failed():
+            response = self.error(503, "backendError")
+        else:
+            response = await handler(request)
+
+        route = request.match_info.route.resource.canonical if request.match_info.route.resource else request.path
+        self.stats[f"{request.method} {route} {response.status}"] += 1
+        return response
+
+    async def handle_stats(self, request):
+        return web.json_response(dict(self.stats))
+
+
+class FakeRuz(FakeService):
+    name = "ruz"
+
+    def __init__(self, dataset: Dataset, faults: Faults):
+        super().__init__(faults)
+        self.dataset = dataset
+
+    def add_routes(self, router):
+        router.add_get("/ruzservice.svc/auditoriums", self.handle_auditoriums)
+        router.add_get("/ruzservice.svc/lessons", self.handle_lessons)
+        router.add_post("/_churn", self.handle_churn)
+
+    async def handle_auditoriums(self, request):
+        return web.json_response(self.dataset.auditoriums)
+
+    async def handle_lessons(self, request):
+        fromdate = request.query.get("fromdate", "")
+        todate = request.query.get("todate", "9999.99.99")
+        auditoriumoid = request.query.get("auditoriumoid")
+        buildingoid = request.query.get("buildingoid")
+
+        classes = [
+            class_
+            for class_ in self.dataset.classes
+            if fromdate <= class_["date"] <= todate
+            and (auditoriumoid is None or str(class_["auditoriumOid"]) == auditoriumoid)
+        ]
+        if auditoriumoid is None and buildingoid is None:
+            return self.error(400, "auditoriumoid or buildingoid is required")
+
+        return web.json_response(classes)
+
+    async def handle_churn(self, request):
+        changed = self.dataset.churn(float(request.query.get("ratio", "0.1")))
+        return web.json_response({"changed": changed})
+
+
+class FakeErudite(FakeService):
+    name = "erudite"
+
+    def __init__(self, dataset: Dataset, faults: Faults):
+        super().__init__(faults)
+        self.dataset = dataset
+        self.lessons = {}
+        self.ids_by_ruz_oid = {}
+        self.next_id = 1
+
+    def add_routes(self, router):
+        router.add_get("/api/erudite/disciplines", self.handle_disciplines)
+        router.add_get("/api/erudite/lessons", self.handle_get_lessons)
+        router.add_post("/api/erudite/lessons", self.handle_add_lesson)
+        router.add_put("/api/erudite/lessons/{lesson_id}", self.handle_update_lesson)
+        router.add_delete("/api/erudite/lessons/{lesson_id}", self.handle_delete_lesson)
+
+    async def handle_disciplines(self, request):
+        emails = self.dataset.streams.get(request.query.get("course_code"))
+        if emails is None:
+            return self.error(404, "Discipline not found")
+        return web.json_response([{"course_code": request.query["course_code"], "emails": emails}])
+
+    async def handle_get_lessons(self, request):
+        fromdate = request.query.get("fromdate", "")[:10]
+        lessons = [
+            lesson
+            for lesson in self.lessons.values()
+            if lesson["date"] >= fromdate
+            and all(
+                str(lesson.get(key)) == request.query[key]
+                for key in ("ruz_auditorium_oid", "ruz_lesson_oid")
+                if key in request.query
+            )
+        ]
+        if not lessons:
+            return self.error(404, "Lessons not found")
+        return web.json_response(lessons)
+
+    async def handle_add_lesson(self, request):
+        lesson = await request.json()
+        existing = self.ids_by_ruz_oid.get(lesson["ruz_lesson_oid"])
+        if existing in self.lessons:
+            return web.json_response(self.lessons[existing], status=409)
+
+        lesson["id"] = self.next_id
+        self.next_id += 1
+        self.lessons[lesson["id"]] = lesson
+        self.ids_by_ruz_oid[lesson["ruz_lesson_oid"]] = lesson["id"]
+        return web.json_response(lesson, status=201)
+
+    async def handle_update_lesson(self, request):
+        lesson_id = int(request.match_info["lesson_id"])
+        if lesson_id not in self.lessons:
+            return self.error(404, "Lesson not found")
+
+        lesson = await request.json()
+        lesson["id"] = lesson_id
+        self.lessons[lesson_id] = lesson
+        return web.json_response(lesson)
+
+    async def handle_delete_lesson(self, request):
+        if self.lessons.pop(int(request.match_info["lesson_id"]), None) is None:
+            return self.error(404, "Lesson not found")
+        return web.json_response({"message": "Lesson deleted"})
+
+
+class FakeGoogle(FakeService):
+    """ Events API with batch requests, errors have the format of Google """
+
+    name = "google"
+
+    def __init__(self, faults: Faults):
+        super().__init__(faults)
+        self.events = {}
+
+    def add_routes(self, router):
+        router.add_route("*", "/calendar/v3/calendars/{calendar_id}/events", self.handle_events)
+        router.add_route("*", "/calendar/v3/calendars/{calendar_id}/events/{event_id}", self.handle_events)
+        router.add_post("/batch/calendar/v3", self.handle_batch)
+
+    def error(self, status: int, reason: str) -> web.Response:
+        status, data = self.google_error(status, reason)
+        return web.json_response(data, status=status)
+
+    @staticmethod
+    def google_error(status: int, reason: str) -> tuple:
+        if reason == "rateLimitExceeded":
+            status = 403
+        return status, {"error": {"code": status, "message": reason, "errors": [{"reason": reason}]}}
+
+    def call(self, method: str, path: str, query: dict, body) -> tuple:
+        """ Handles one call of the events API, returns (status, body) """
+
+        match = EVENT_PATH.match(path)
+        if match is None:
+            return self.google_error(404, "notFound")
+
+        calendar_id, event_id = unquote(match.group(1)), match.group(2)
+        calendar = self.events.setdefault(calendar_id, {})
+
+        if event_id is None and method == "POST":
+            event = dict(body, id=uuid4().hex, status="confirmed", creator={"email": CREATOR_EMAIL})
+            calendar[event["id"]] = event
+            return 200, event
+
+        if event_id is None and method == "GET":
+            events = sorted(calendar.values(), key=lambda event: event["start"]["dateTime"])
+            start = int(query.get("pageToken", 0))
+            size = int(query.get("maxResults", 250))
+            data = {"items": events[start : start + size]}
+            if start + size < len(events):
+                data["nextPageToken"] = str(start + size)
+            return 200, data
+
+        if event_id not in calendar:
+            return self.google_error(404, "notFound")
+
+        if method == "PUT":
+            calendar[event_id] = dict(body, id=event_id, status="confirmed", creator={"email": CREATOR_EMAIL})
+            return 200, calendar[event_id]
+        if method == "DELETE":
+            del calendar[event_id]
+            return 204, None
+
+        return self.google_error(405, "methodNotAllowed")
+
+    async def handle_events(self, request):
+        body = await request.json() if request.can_read_body else None
+        status, data = self.call(request.method, request.path, request.query, body)
+        if data is None:
+            return web.Response(status=status)
+        return web.json_response(data, status=status)
+
+    async def handle_batch(self, request):
+        boundary = request.content_type_params["boundary"]
+        text = await request.text()
+
+        parts = []
+        for part in text.split(f"--{boundary}"):
+            part = part.strip("\r\n")
+            if not part or part == "--":
+                continue
+
+            outer_headers, _, http_message = part.partition("\r\n\r\n")
+            content_id = re.search(r"Content-ID: <(.+)>", outer_headers).group(1)
+            request_line, _, rest = http_message.partition("\r\n")
+            method, path, _ = request_line.split(" ")
+            _, _, body = rest.partition("\r\n\r\n")
+
+            # Google applies limits and errors to every call of the batch separately
+            if self.faults.limited():
+                status, data = self.google_error(429, "rateLimitExceeded")
+            elif self.faults.failed():
+                status, data = self.google_error(503, "backendError")
+            else:
+                status, data = self.call(method, path, {}, json.loads(body) if body.strip() else None)
+            self.stats[f"{method} batch item {status}"] += 1
+
+            parts.append(
+                f"--batch_response\r\n"
+                "Content-Type: application/http\r\n"
+                f"Content-ID: <response-{content_id}>\r\n\r\n"
+                f"HTTP/1.1 {status} {'OK' if status < 400 else 'Error'}\r\n"
+                "Content-Type: application/json\r\n\r\n"
+                f"{json.dumps(data) if data is not None else ''}\r\n"
+            )
+        parts.append("--batch_response--\r\n")
+
+        return web.Response(
+            text="".join(parts), headers={"Content-Type": "multipart/mixed; boundary=batch_response"}
+        )
+
+
+async def start_services(dataset: Dataset, faults: dict, host: str = "127.0.0.1") -> list:
+    """ Starts the fake services, faults - service name -> Faults, returns runners for cleanup """
+
+    services = [
+        (FakeRuz(dataset, faults.get("ruz", Faults())), RUZ_PORT),
+        (FakeErudite(dataset, faults.get("erudite", Faults())), ERUDITE_PORT),
+        (FakeGoogle(faults.get("google", Faults())), GOOGLE_PORT),
+    ]
+
+    runners = []
+    for service, port in services:
+        runner = web.AppRunner(service.app(), access_log=None)
+        await runner.setup()
+        await web.TCPSite(runner, host, port).start()
+        runners.append(runner)
+    return runners
+
+
+def service_urls(host: str = "127.0.0.1") -> dict:
+    return {
+        "ruz": f"http://{host}:{RUZ_PORT}",
+        "erudite": f"http://{host}:{ERUDITE_PORT}",
+        "google": f"http://{host}:{GOOGLE_PORT}",
+    }
+
+
+def add_arguments(parser: argparse.ArgumentParser):
+    """ Arguments of the dataset and faults, shared with the benchmark runner """
+
+    parser.add_argument("--rooms", type=int, default=20)
+    parser.add_argument("--lessons", type=int, default=30, help="lessons of every room in the period")
+    parser.add_argument("--period", type=int, default=14)
+    parser.add_argument("--online-ratio", type=float, default=0.2)
+    parser.add_argument("--seed", type=int, default=0)
+    for service in ("ruz", "erudite", "google"):
+        parser.add_argument(f"--{service}-latency", type=float, default=0.02, help="seconds")
+        parser.add_argument(f"--{service}-jitter", type=float, default=0.01, help="seconds")
+        parser.add_argument(f"--{service}-rate", type=float, default=None, help="requests per second")
+        parser.add_argument(f"--{service}-error-rate", type=float, default=0.0)
+
+
+def build(args) -> tuple:
+    """ Dataset and faults from parsed arguments """
+
+    dataset = Dataset(
+        rooms=args.rooms,
+        lessons_per_room=args.lessons,
+        period=args.period,
+        online_ratio=args.online_ratio,
+        seed=args.seed,
+    )
+    faults = {
+        service: Faults(
+            latency=getattr(args, f"{service}_latency"),
+            jitter=getattr(args, f"{service}_jitter"),
+            rate=getattr(args, f"{service}_rate"),
+            error_rate=getattr(args, f"{service}_error_rate"),
+            seed=args.seed,
+        )
+        for service in ("ruz", "erudite", "google")
+    }
+    return dataset, faults
+
+
+def serve_forever(args):
+    """ Runs the fake services until the process is stopped """
+
+    dataset, faults = build(args)
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    loop.run_until_complete(start_services(dataset, faults))
+    loop.run_forever()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fake RUZ, Erudite and Google Calendar")
+    add_arguments(parser)
+    serve_forever(parser.parse_args())
@@ -0,0 +1,230 @@
+"""
+End-to-end benchmark of CalendarManager.get_rooms against local fake services
+
+RUZ, Erudite and Google Calendar are replaced by fake services (benchmark.fake_services) in a child process,
+PostgreSQL is real: the benchmark needs a scratch database, its rooms, users and sync state are rewritten.
+
+Run from the gcalendar_ruz directory:
+    python -m benchmark.run --db-url postgresql://localhost/gcalendar_bench --rooms 50 --lessons 40
+
+Passes:
+    cold - Erudite and the calendar are empty, every lesson is added
+    warm - nothing changed since the previous pass
+    churn - a part of lessons (--churn-ratio) changed in RUZ
+"""
+
+from multiprocessing import Process
+from tempfile import TemporaryDirectory
+import argparse
+import asyncio
+import json
+import os
+import pickle
+import resource
+import sys
+import time
+import tracemalloc
+import urllib.request
+
+from .fake_services import add_arguments, build, serve_forever, service_urls
+from .datasets import CREATOR_EMAIL
+
+
+PASSES = ("cold", "warm", "churn")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark of the synchronization against fake services")
+    parser.add_argument("--db-url", required=True, help="scratch PostgreSQL database, its data is rewritten")
+    parser.add_argument("--passes", default=",".join(PASSES), help=f"comma separated passes from {PASSES}")
+    parser.add_argument("--churn-ratio", type=float, default=0.1)
+    parser.add_argument(
+        "--redis",
+        metavar="URL",
+        help="scratch redis database (e.g. redis://localhost:6379/15) used as the shared cache, "
+        "it is flushed before every pass",
+    )
+    parser.add_argument("--trace-memory", action="store_true", help="measure python heap peak of every pass")
+    parser.add_argument("--verbose", action="store_true", help="show logs of the synchronization")
+    add_arguments(parser)
+    return parser.parse_args()
+
+
+def fake_stats(url: str) -> dict:
+    with urllib.request.urlopen(f"{url}/_stats") as response:
+        return json.loads(response.read())
+
+
+def wait_for_services(urls: dict, timeout: float = 30):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            for url in urls.values():
+                fake_stats(url)
+            return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.1)
+
+
+def configure_environment(args, urls: dict, workdir: str):
+    """ Points settings to the fake services, must be called before anything from core is imported """
+
+    from google.oauth2.credentials import Credentials
+
+    token_path = os.path.join(workdir, "token.pickle")
+    with open(token_path, "wb") as token:
+        pickle.dump(Credentials(token="benchmark"), token)
+
+    os.environ.update(
+        DB_URL=args.db_url,
+        PERIOD=str(args.period),
+        RUZ_API_URL=f"{urls['ruz']}/ruzservice.svc",
+        NVR_API_URL=f"{urls['erudite']}/api/erudite",
+        GOOGLE_API_URL=urls["google"],
+        TOKEN_PATH=token_path,
+        CREDS_PATH=os.path.join(workdir, "credentials.json"),
+    )
+    os.environ.setdefault("NVR_API_KEY", "benchmark")
+    if args.redis:
+        os.environ["URL_REDIS"] = args.redis
+    else:
+        os.environ.setdefault("URL_REDIS", "redis://localhost:6379/0")
+
+
+def seed_database(session, dataset):
+    """ Rooms, online rooms and the creator of events for the dataset, previous results are removed """
+
+    from core.db.models import Base, Room, OnlineRoom, User, Record, UserRecord, LessonSyncState
+
+    Base.metadata.create_all(bind=session.get_bind())
+    for model in (UserRecord, Record, LessonSyncState):
+        session.query(model).delete(synchronize_session=False)
+
+    for auditorium in dataset.auditoriums:
+        room = session.query(Room).filter_by(name=auditorium["number"]).first() or Room(name=auditorium["number"])
+        room.ruz_id = auditorium["auditoriumOid"]
+        room.calendar = f"room-{auditorium['number']}@benchmark"
+        session.add(room)
+
+    for name in ("РУЗ", "Jitsi"):
+        online_room = session.query(OnlineRoom).filter_by(name=name).first() or OnlineRoom(name=name)
+        online_room.calendar = f"{name.lower()}@benchmark"
+        session.add(online_room)
+
+    if session.query(User).filter_by(email=CREATOR_EMAIL).first() is None:
+        session.add(User(email=CREATOR_EMAIL))
+
+
+def requests_by_service(before: dict, after: dict) -> dict:
+    result = {}
+    for service, stats in after.items():
+        result[service] = {
+            key: count - before[service].get(key, 0)
+            for key, count in stats.items()
+            if count != before[service].get(key, 0)
+        }
+    return result
+
+
+async def run_passes(args, urls: dict, dataset) -> list:
+    from loguru import logger
+    from main import CalendarManager
+    from core.context import app
+    from core.redis_caching import caching
+
+    if not args.verbose:
+        logger.remove()
+        logger.add(sys.stderr, level="WARNING")
+
+    if args.redis and await caching.redis_connect() is None:
+        raise SystemExit(f"Redis {args.redis} is not available")
+
+    manager = CalendarManager()
+    await manager.db.run(seed_database, dataset)
+
+    lessons = len(dataset.classes)
+    results = []
+    try:
+        for name in args.passes.split(","):
+            if name == "churn":
+                request = urllib.request.Request(f"{urls['ruz']}/_churn?ratio={args.churn_ratio}", method="POST")
+                urllib.request.urlopen(request).close()
+
+            # Every pass gets lessons from RUZ again, as a run after the cache expired
+            caching.local_cache.clear()
+            caching.reset_reference_cache()
+            if args.redis:
+                await caching.client.flushdb()
+            before = {service: fake_stats(url) for service, url in urls.items()}
+            if args.trace_memory:
+                tracemalloc.start()
+
+            started_at = time.monotonic()
+            plan = await manager.get_rooms()
+            elapsed = time.monotonic() - started_at
+
+            heap_peak = None
+            if args.trace_memory:
+                heap_peak = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+
+            after = {service: fake_stats(url) for service, url in urls.items()}
+            results.append(
+                {
+                    "pass": name,
+                    "seconds": elapsed,
+                    "lessons_per_second": lessons / elapsed if elapsed else 0,
+                    "requests": requests_by_service(before, after),
+                    "planned": plan.estimate(),
+                    "heap_peak_bytes": heap_peak,
+                    "max_rss_bytes": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+                }
+            )
+    finally:
+        await app.close()
+
+    return results
+
+
+def report(results: list, lessons: int):
+    print(f"Lessons in the dataset: {lessons}")
+    for result in results:
+        print(
+            f"\n{result['pass']}: {result['seconds']:.2f}s, {result['lessons_per_second']:.1f} lessons/s, "
+            f"max RSS {result['max_rss_bytes'] / 2 ** 20:.1f} MB"
+            + (
+                f", heap peak {result['heap_peak_bytes'] / 2 ** 20:.1f} MB"
+                if result["heap_peak_bytes"] is not None
+                else ""
+            )
+        )
+        print(f"  planned writes: {result['planned']}")
+        for service, stats in result["requests"].items():
+            total = sum(count for key, count in stats.items() if " batch item " not in key)
+            print(f"  {service}: {total} requests")
+            for key, count in sorted(stats.items()):
+                print(f"    {key}: {count}")
+
+
+def main():
+    args = parse_args()
+    dataset, _ = build(args)
+    urls = service_urls()
+
+    services = Process(target=serve_forever, args=(args,), daemon=True)
+    services.start()
+    try:
+        wait_for_services(urls)
+        with TemporaryDirectory() as workdir:
+            configure_environment(args, urls, workdir)
+            results = asyncio.get_event_loop().run_until_complete(run_passes(args, urls, dataset))
+        report(results, len(dataset.classes))
+    finally:
+        services.terminate()
+        services.join()
+
+
+if __name__ == "__main__":
+    main()
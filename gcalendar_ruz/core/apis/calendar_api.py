@@ -1,13 +1,13 @@
-import os.path
-import pickle
-from aiohttp import ClientSession
+import json
+import asyncio
+from uuid import uuid4
+from urllib.parse import quote
 from loguru import logger
 from datetime import datetime, timedelta
 
-from google.auth.transport.requests import Request
-from google_auth_oauthlib.flow import InstalledAppFlow
-
-from ..utils import semlock, GOOGLE, token_check, handle_google_errors
+from ..utils import semlock, service_slot, GOOGLE, handle_google_errors
+from .credentials import GoogleCredentials
+from .sessions import send
 from ..settings import settings
 
 
@@ -15,36 +15,183 @@ CREDS_PATH = settings.creds_path
 TOKEN_PATH = settings.token_path
 SCOPES = "https://www.googleapis.com/auth/calendar"
 
+GOOGLE_API_URL = settings.google_api_url
+CALENDAR_API_PATH = "/calendar/v3"
+BATCH_URL = f"{GOOGLE_API_URL}/batch/calendar/v3"
+# Google Calendar accepts at most 50 calls in one batch request
+BATCH_LIMIT = 50
+
+# Biggest page of events list allowed by Google
+EVENTS_PAGE_SIZE = 2500
+# Partial response: only fields that are used by the module
+EVENT_FIELDS = "items(id,status,summary,start,end,updated),nextPageToken"
+
+
+def build_batch_body(items: list, boundary: str) -> str:
+    """ Builds multipart/mixed body of a batch request """
+
+    parts = []
+    for index, (method, path, body, _) in enumerate(items):
+        part = (
+            f"--{boundary}\r\n"
+            "Content-Type: application/http\r\n"
+            f"Content-ID: <item{index}>\r\n\r\n"
+            f"{method} {CALENDAR_API_PATH}{path} HTTP/1.1\r\n"
+        )
+        if body is not None:
+            part += f"Content-Type: application/json\r\n\r\n{json.dumps(body)}\r\n"
+        else:
+            part += "\r\n"
+        parts.append(part)
+    parts.append(f"--{boundary}--\r\n")
+
+    return "".join(parts)
+
+
+def parse_batch_response(text: str, boundary: str) -> dict:
+    """
+    Parses multipart/mixed response of a batch request
+    Returns dict: item index -> decoded body of the item response (None if the body is empty)
+    """
+
+    results = {}
+    for part in text.replace("\r\n", "\n").split(f"--{boundary}"):
+        part = part.strip("\n")
+        if not part or part == "--":
+            continue
+
+        outer_headers, _, http_message = part.partition("\n\n")
+        content_id = None
+        for header in outer_headers.split("\n"):
+            name, _, value = header.partition(":")
+            if name.strip().lower() == "content-id":
+                content_id = value.strip().strip("<>")
+        if content_id is None:
+            continue
+
+        status_and_headers, _, body = http_message.partition("\n\n")
+        status = int(status_and_headers.split("\n")[0].split(" ")[1])
+        body = body.strip()
+        if body:
+            body = json.loads(body)
+        else:
+            body = None
+        if status >= 400 and not (isinstance(body, dict) and body.get("error")):
+            body = {"error": {"code": status, "errors": []}}
+
+        index = int(content_id.replace("response-item", ""))
+        results[index] = body
+
+    return results
+
+
+class EventBatch:
+    """
+    Collects event requests and sends them to Google in multipart batch requests
+    Every caller gets back the result of its own request
+    """
+
+    SERVICE = GOOGLE
+
+    def __init__(self, calendar: "GCalendar"):
+        self.calendar = calendar
+        self.size = min(settings.google_batch_size, BATCH_LIMIT)
+        self.delay = settings.google_batch_delay
+        self.pending = []
+        self.flush_handle = None
+        self.tasks = set()
+
+    async def request(self, method: str, path: str, body: dict = None):
+        """ Adds request to the next batch and waits for its result """
+
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.pending.append((method, path, body, future))
+
+        if len(self.pending) >= self.size:
+            self.flush()
+        elif self.flush_handle is None:
+            self.flush_handle = loop.call_later(self.delay, self.flush)
+
+        return await future
+
+    def flush(self):
+        """ Sends all pending requests """
+
+        if self.flush_handle is not None:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+
+        while self.pending:
+            items = self.pending[: self.size]
+            self.pending = self.pending[self.size :]
+
+            task = asyncio.ensure_future(self.send(items))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+    async def send(self, items: list):
+        try:
+            # Google counts every request of the batch against the quota
+            async with service_slot(self.SERVICE, cost=len(items)):
+                results = await self.post_batch(items)
+        except Exception as err:
+            logger.error(f"Batch request to google failed - {err}")
+            for *_, future in items:
+                if not future.done():
+                    future.set_exception(err)
+            return
+
+        for index, (*_, future) in enumerate(items):
+            if not future.done():
+                future.set_result(results.get(index))
+
+    async def post_batch(self, items: list) -> dict:
+        boundary = f"batch_{uuid4().hex}"
+        auth_header = await self.calendar.credentials.headers()
+        headers = dict(auth_header, **{"Content-Type": f"multipart/mixed; boundary={boundary}"})
+
+        res = await send(
+            self.SERVICE,
+            "POST",
+            BATCH_URL,
+            cost=len(items),
+            data=build_batch_body(items, boundary),
+            headers=headers,
+        )
+        async with res:
+            if res.status == 401:
+                self.calendar.credentials.reject(auth_header)
+
+            if res.content_type != "multipart/mixed":
+                # The whole batch failed, so every request gets the same error
+                error = await res.json(content_type=None)
+                return {index: error for index in range(len(items))}
+
+            response_boundary = res.content_type_params.get("boundary")
+            text = await res.text()
+
+        logger.info(f"Batch of {len(items)} requests sent to google")
+        results = parse_batch_response(text, response_boundary)
+
+        # Google can reject the token in every request of the batch, while the batch itself succeeds
+        if any(isinstance(result, dict) and result.get("error", {}).get("code") == 401 for result in results.values()):
+            self.calendar.credentials.reject(auth_header)
+
+        return results
+
 
 class GCalendar:
     SERVICE = GOOGLE
 
     def __init__(self):
         """
-        Setting up calendar
+        Setting up calendar, credentials are loaded by the first request
         """
 
-        self.refresh_token()
+        self.credentials = GoogleCredentials(TOKEN_PATH, CREDS_PATH, SCOPES)
         self.period = settings.period
-
-        self.HEADERS = {
-            "Content-Type": "application/json",
-            "Authorization": f"Bearer {self.creds.token}",
-        }
-
-    def refresh_token(self):
-        self.creds = None
-        if os.path.exists(TOKEN_PATH):
-            with open(TOKEN_PATH, "rb") as token:
-                self.creds = pickle.load(token)
-        if not self.creds or not self.creds.valid:
-            if self.creds and self.creds.expired and self.creds.refresh_token:
-                self.creds.refresh(Request())
-            else:
-                flow = InstalledAppFlow.from_client_secrets_file(CREDS_PATH, SCOPES)
-                self.creds = flow.run_local_server(port=0)
-            with open(TOKEN_PATH, "wb") as token:
-                pickle.dump(self.creds, token)
+        self.batch = EventBatch(self)
 
     def parse_lesson_to_event(self, lesson: dict) -> dict:
         """
@@ -75,75 +222,85 @@ class GCalendar:
         event["reminders"] = {"useDefault": True}
         return event
 
-    @handle_google_errors
-    @token_check
+    async def send_event_request(
+        self, method: str, path: str, event: dict = None, batched: bool = False
+    ):
+        """ Sends request either as a part of a batch or by itself """
+
+        if batched:
+            return await self.batch.request(method, path, event)
+        return await self.send_single_request(method, path, event)
+
     @semlock
+    async def send_single_request(self, method: str, path: str, event: dict = None):
+        headers = await self.credentials.headers()
+        res = await send(
+            self.SERVICE,
+            method,
+            f"{GOOGLE_API_URL}{CALENDAR_API_PATH}{path}",
+            json=event,
+            headers=headers,
+        )
+        async with res:
+            if res.status == 401:
+                self.credentials.reject(headers)
+            try:
+                return await res.json(content_type=None)
+            except Exception:
+                logger.info(f"{method} {path} returned code - {res.status}.")
+                return {"error": {"code": res.status, "errors": []}}
+
+    @handle_google_errors
     async def create_event(
         self,
         calendar_id: str,
         lesson: dict,
+        batched: bool = False,
     ) -> str:
         event = self.parse_lesson_to_event(lesson)
 
-        async with ClientSession() as session:
-            event_post = await session.post(
-                f"https://www.googleapis.com/calendar/v3/calendars/{calendar_id}/events",
-                json=event,
-                headers=self.HEADERS,
-            )
-            async with event_post:
-                event_json = await event_post.json()
+        event_json = await self.send_event_request(
+            "POST", f"/calendars/{quote(calendar_id)}/events", event, batched
+        )
         logger.info("Event created")
 
         return event_json
 
     @handle_google_errors
-    @token_check
-    @semlock
-    async def delete_event(self, calendar_id, event_id):
-        async with ClientSession() as session:
-            res = await session.delete(
-                f"https://www.googleapis.com/calendar/v3/calendars/{calendar_id}/events/{event_id}",
-                headers=self.HEADERS,
-            )
-            async with res:
-                try:
-                    res = await res.json()
-                except:
-                    print(res)
+    async def delete_event(self, calendar_id, event_id, batched: bool = False):
+        res = await self.send_event_request(
+            "DELETE", f"/calendars/{quote(calendar_id)}/events/{event_id}", batched=batched
+        )
 
         if res is None:
             logger.info("Event deleted from Google Calendar")
-        else:
-            print(res)
-            return res
+            return None
+
+        # Event is already deleted
+        if res.get("error", {}).get("code") in (404, 410):
+            logger.info(f"Event {event_id} is not found in Google Calendar")
+            return None
+
+        return res
 
     @handle_google_errors
-    @token_check
-    @semlock
-    async def update_event(self, calendar_id: str, event_id: str, lesson: dict) -> str:
+    async def update_event(
+        self, calendar_id: str, event_id: str, lesson: dict, batched: bool = False
+    ) -> str:
         """ Updates an event in the google calendar """
 
         event = self.parse_lesson_to_event(lesson)
 
-        async with ClientSession() as session:
-            res = await session.put(
-                f"https://www.googleapis.com/calendar/v3/calendars/{calendar_id}/events/{event_id}",
-                json=event,
-                headers=self.HEADERS,
-            )
-            async with res:
-                try:
-                    res = await res.json()
-                except:
-                    logger.info(f"Update event returned code - {res.status}.")
-                    return res
+        res = await self.send_event_request(
+            "PUT", f"/calendars/{quote(calendar_id)}/events/{event_id}", event, batched
+        )
 
         logger.info(f"Update event returned code - {res.get('status')}.")
         return res
 
-    @token_check
-    async def get_events(self, calendar_id: str) -> dict:
+    async def get_events(self, calendar_id: str, fields: str = EVENT_FIELDS) -> list:
+        """ Gets all events for the period, only fields from `fields` are returned """
+
         now = datetime.utcnow()
         nowISO = now.isoformat() + "Z"  # 'Z' indicates UTC time
         nowffISO = (now + timedelta(days=self.period)).isoformat() + "Z"
@@ -152,16 +309,42 @@ class GCalendar:
             "timeMax": nowffISO,
             "singleEvents": "True",
             "orderBy": "startTime",
-            "maxResults": 2499,
         }
-        async with ClientSession() as session:
-            res = await session.get(
-                f"https://www.googleapis.com/calendar/v3/calendars/{calendar_id}/events",
-                headers=self.HEADERS,
-                params=params,
-            )
-            async with res:
-                data = await res.json()
-
-        events = data.get("items", [])
-        return events
+
+        return await self.list_events(calendar_id, params, fields)
+
+    async def list_events(self, calendar_id: str, params: dict, fields: str) -> list:
+        """ Goes through all pages of the events list, if a page fails, events of the previous pages are returned """
+
+        params = dict(params, maxResults=EVENTS_PAGE_SIZE, fields=fields)
+        events = []
+        while True:
+            status, data = await self.get_events_page(calendar_id, params)
+
+            if status != 200:
+                logger.error(f"Listing of events failed - {data}")
+                return events
+
+            events += data.get("items", [])
+
+            page_token = data.get("nextPageToken")
+            if not page_token:
+                return events
+            params["pageToken"] = page_token
+
+    @semlock
+    async def get_events_page(self, calendar_id: str, params: dict) -> tuple:
+        headers = await self.credentials.headers()
+        res = await send(
+            self.SERVICE,
+            "GET",
+            f"{GOOGLE_API_URL}{CALENDAR_API_PATH}/calendars/{quote(calendar_id)}/events",
+            headers=headers,
+            params=params,
+        )
+        async with res:
+            if res.status == 401:
+                self.credentials.reject(headers)
+            data = await res.json(content_type=None)
+
+        return res.status, data
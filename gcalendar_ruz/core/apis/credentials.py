@@ -0,0 +1,215 @@
+from datetime import datetime
+import asyncio
+import json
+import os.path
+import pickle
+import time
+from loguru import logger
+
+from google.auth.transport.requests import Request
+from google_auth_oauthlib.flow import InstalledAppFlow
+
+from .. import metrics
+from ..redis_caching import caching
+
+
+# Token is refreshed in background this long before it expires
+REFRESH_MARGIN = 300
+# Requests wait for a refresh, if the token is valid for less than this
+MIN_VALIDITY = 30
+
+# Workers share the access token through redis, only the worker holding the lock refreshes it
+SHARED_TOKEN_KEY = "google_access_token"
+REFRESH_LOCK_KEY = f"lock:{SHARED_TOKEN_KEY}"
+REFRESH_LOCK_TIMEOUT = 30
+SHARED_POLL_INTERVAL = 0.2
+
+
+class GoogleCredentials:
+    """
+    Google access token shared by all coroutines of the process and, through redis, by all workers
+
+    headers() returns the cached authorization header. The token is refreshed in background
+    REFRESH_MARGIN seconds before it expires, requests wait only for a token that is (almost) expired.
+    Concurrent callers share one refresh, the pickle file and the http refresh are run in a thread.
+    The refresh token is read from the pickle at token_path, access tokens are taken from redis if another
+    worker has already refreshed them, the pickle is rewritten only without redis or after a new login.
+    """
+
+    def __init__(self, token_path: str, creds_path: str, scopes: str):
+        self.token_path = token_path
+        self.creds_path = creds_path
+        self.scopes = scopes
+
+        self.creds = None
+        self.header = None
+        self.refresh_task = None
+        # Token that Google didn't accept, it is not taken from redis again
+        self.rejected = None
+
+    def expires_in(self) -> float:
+        if self.creds is None or not self.creds.token:
+            return 0
+        if self.creds.expiry is None:
+            return float("inf")
+        return (self.creds.expiry - datetime.utcnow()).total_seconds()
+
+    async def headers(self) -> dict:
+        """ Authorization header of requests to Google, it must not be changed """
+
+        expires_in = self.expires_in()
+        if self.header is None or expires_in < MIN_VALIDITY:
+            # The refresh is shared, so a cancelled request doesn't cancel it for others
+            await asyncio.shield(self.refresh())
+        elif expires_in < REFRESH_MARGIN:
+            self.refresh()
+
+        return self.header
+
+    def reject(self, header: dict):
+        """ Google answered 401 to the header, its token is refreshed before the next request """
+
+        if self.header is None or header.get("Authorization") != self.header["Authorization"]:
+            # The token has already been refreshed
+            return
+
+        logger.warning("Google didn't accept the access token")
+        self.rejected = self.creds.token
+        self.header = None
+
+    def refresh(self) -> asyncio.Future:
+        """ Starts a refresh or returns the running one """
+
+        if self.refresh_task is None or self.refresh_task.done():
+            self.refresh_task = asyncio.ensure_future(self.update())
+            self.refresh_task.add_done_callback(self.refresh_done)
+        return self.refresh_task
+
+    @staticmethod
+    def refresh_done(task: asyncio.Future):
+        if not task.cancelled() and task.exception():
+            logger.error(f"Refresh of google token failed - {task.exception()}")
+
+    async def update(self):
+        loop = asyncio.get_running_loop()
+        if self.creds is None:
+            self.creds = await loop.run_in_executor(None, self.load)
+
+        if self.expires_in() < REFRESH_MARGIN or self.creds.token == self.rejected:
+            if not await self.take_shared():
+                locked = await self.lock()
+                try:
+                    if locked or not await self.wait_for_shared():
+                        started_at = time.monotonic()
+                        await loop.run_in_executor(None, self.refresh_blocking)
+                        metrics.TOKEN_REFRESHES.inc()
+                        logger.info(f"Google token refreshed in {time.monotonic() - started_at:.2f} seconds")
+                        await self.share()
+                finally:
+                    if locked:
+                        await self.unlock()
+
+        self.rejected = None
+        self.header = {"Authorization": f"Bearer {self.creds.token}"}
+
+    def load(self):
+        """ Runs in a thread: reads credentials saved by the previous login """
+
+        if not os.path.exists(self.token_path):
+            return None
+        with open(self.token_path, "rb") as token:
+            return pickle.load(token)
+
+    def refresh_blocking(self):
+        """ Runs in a thread: refreshes the access token, or asks to log in if there is no refresh token """
+
+        if self.creds and self.creds.refresh_token:
+            self.creds.refresh(Request())
+            save = caching.client is None
+        else:
+            flow = InstalledAppFlow.from_client_secrets_file(self.creds_path, self.scopes)
+            self.creds = flow.run_local_server(port=0)
+            save = True
+
+        if save:
+            with open(self.token_path, "wb") as token:
+                pickle.dump(self.creds, token)
+
+    async def take_shared(self) -> bool:
+        """ Takes the access token refreshed by another worker, if it is fresh enough """
+
+        if caching.client is None or self.creds is None:
+            return False
+
+        try:
+            data = await caching.client.get(SHARED_TOKEN_KEY)
+        except Exception as err:
+            logger.warning(f"Shared google token is not available - {err}")
+            return False
+        if data is None:
+            return False
+
+        shared = json.loads(data)
+        expiry = datetime.fromisoformat(shared["expiry"])
+        if shared["token"] == self.rejected or (expiry - datetime.utcnow()).total_seconds() < REFRESH_MARGIN:
+            return False
+
+        self.creds.token = shared["token"]
+        self.creds.expiry = expiry
+        logger.info("Google token is taken from redis")
+        return True
+
+    async def wait_for_shared(self) -> bool:
+        """ Waits while another worker refreshes the token, False if it failed or took too long """
+
+        deadline = time.monotonic() + REFRESH_LOCK_TIMEOUT
+        while time.monotonic() < deadline:
+            await asyncio.sleep(SHARED_POLL_INTERVAL)
+
+            if await self.take_shared():
+                return True
+            try:
+                if not await caching.client.exists(REFRESH_LOCK_KEY):
+                    return await self.take_shared()
+            except Exception:
+                return False
+
+        return False
+
+    async def share(self):
+        """ Gives the access token to other workers until it expires """
+
+        if caching.client is None or self.creds.expiry is None:
+            return
+
+        ttl = int(self.expires_in())
+        if ttl <= 0:
+            return
+
+        value = json.dumps({"token": self.creds.token, "expiry": self.creds.expiry.isoformat()})
+        try:
+            await caching.client.set(SHARED_TOKEN_KEY, value, ex=ttl)
+        except Exception as err:
+            logger.warning(f"Google token could not be shared - {err}")
+
+    async def lock(self) -> bool:
+        """ True if this worker refreshes the token, False if another worker is already refreshing it """
+
+        if caching.client is None:
+            return True
+
+        try:
+            return bool(await caching.client.set(REFRESH_LOCK_KEY, "1", ex=REFRESH_LOCK_TIMEOUT, nx=True))
+        except Exception as err:
+            logger.warning(f"Refresh of google token is not coordinated with other workers - {err}")
+            return True
+
+    async def unlock(self):
+        if caching.client is None:
+            return
+
+        try:
+            await caching.client.delete(REFRESH_LOCK_KEY)
+        except Exception as err:
+            # The lock is freed by its expiration
+            logger.warning(f"Lock of google token could not be released - {err}")
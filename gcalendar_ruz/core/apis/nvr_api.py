@@ -1,44 +1,65 @@
-from aiohttp import ClientSession
+import asyncio
 from loguru import logger
-import time
 from datetime import datetime
 import pytz
 
 from ..settings import settings
 from ..utils import semlock, NVR
 from .calendar_api import GCalendar
+from .sessions import send
+from ..redis_caching.caching import reference_cache
+
+
+# How many lessons are deleted at the same time
+DELETE_CONCURRENCY = 20
+
+# Course emails change rarely: keep them for a week, refresh in background once a day
+REFERENCE_TTL = 7 * 24 * 60 * 60
+REFERENCE_REFRESH_AFTER = 24 * 60 * 60
+
+
+class EruditeError(Exception):
+    """ Erudite failed to answer, the result must not be cached """
 
 
 class Nvr_Api:
-    NVR_API_URL = "https://nvr.miem.hse.ru/api/erudite"
+    NVR_API_URL = settings.nvr_api_url
     NVR_API_KEY = settings.nvr_api_key
     SERVICE = NVR
-    calendar = GCalendar()
 
-    def __init__(self) -> None:
+    def __init__(self, calendar: GCalendar = None) -> None:
+        self.calendar = calendar or GCalendar()
+        self.refresh_date()
+
+    def refresh_date(self):
+        """ Lessons are requested from Erudite starting from this moment """
+
         tzmoscow = pytz.timezone("Europe/Moscow")
         self.dt: str = (
             datetime.now().replace(microsecond=0, tzinfo=tzmoscow).isoformat()
         )
 
+    @reference_cache(ttl=REFERENCE_TTL, refresh_after=REFERENCE_REFRESH_AFTER)
     @semlock
     async def get_course_emails(self, course_code: str):
         """ Gets emails from a GET responce from Erudite """
 
-        async with ClientSession() as session:
-            res = await session.get(
-                f"{self.NVR_API_URL}/disciplines",
-                params={"course_code": course_code},
-                headers={"key": self.NVR_API_KEY},
-            )
-            async with res:
-                data = await res.json()
+        res = await send(
+            self.SERVICE,
+            "GET",
+            f"{self.NVR_API_URL}/disciplines",
+            params={"course_code": course_code},
+            headers={"key": self.NVR_API_KEY},
+        )
+        async with res:
+            if res.status == 404:
+                # The discipline is not found, it has no emails
+                return []
+            if res.status != 200:
+                raise EruditeError(f"Emails of {course_code} could not be got, Erudite returned {res.status}")
+            data = await res.json()
 
-        # If the responce is not list -> the responce is a message that discipline is not found, and it should not be analysed further
-        if res.status == 200:
-            grp_emails = data[0].get("emails")
-        else:
-            return []
+        grp_emails = data[0].get("emails")
 
         if grp_emails == [""]:
             return []
@@ -49,14 +70,17 @@ class Nvr_Api:
     async def add_lesson(self, lesson: dict) -> int:
         """ Posts a lesson to Erudite """
 
-        async with ClientSession() as session:
-            res = await session.post(
-                f"{self.NVR_API_URL}/lessons",
-                json=lesson,
-                headers={"key": self.NVR_API_KEY},
-            )
-            async with res:
-                data = await res.json()
+        res = await send(
+            self.SERVICE,
+            "POST",
+            f"{self.NVR_API_URL}/lessons",
+            # Erudite answers 409 to a lesson, that is already added, so the request can be repeated
+            idempotent=True,
+            json=lesson,
+            headers={"key": self.NVR_API_KEY},
+        )
+        async with res:
+            data = await res.json()
 
         if res.status == 201:
             logger.info("Lesson added to Erudite")
@@ -69,51 +93,58 @@ class Nvr_Api:
     async def delete_lesson(self, lesson_id: str):
         """ Deletes a lesson from Erudite """
 
-        async with ClientSession() as session:
-            res = await session.delete(
-                f"{self.NVR_API_URL}/lessons/{lesson_id}",
-                headers={"key": self.NVR_API_KEY},
-            )
-            async with res:
-                await res.json()
+        res = await send(
+            self.SERVICE,
+            "DELETE",
+            f"{self.NVR_API_URL}/lessons/{lesson_id}",
+            headers={"key": self.NVR_API_KEY},
+        )
+        async with res:
+            await res.json()
 
         if res.status == 200:
             logger.info(f"Lesson with id: {lesson_id} deleted")
-            return
+            return True
         elif res.status == 404:
             logger.info(f"Lesson with id: {lesson_id} is not found in Erudite")
+            return True
         else:
             logger.error("Erudite is not working properly...")
+            return False
 
     @semlock
-    async def update_lesson(self, lesson_id: str, lesson_data: dict):
-        """ Updates a lesson in Erudite """
-
-        async with ClientSession() as session:
-            res = await session.put(
-                f"{self.NVR_API_URL}/lessons/{lesson_id}",
-                json=lesson_data,
-                headers={"key": self.NVR_API_KEY},
-            )
-            async with res:
-                await res.json()
+    async def update_lesson(self, lesson_id: str, lesson_data: dict) -> bool:
+        """ Updates a lesson in Erudite, returns True on success """
+
+        res = await send(
+            self.SERVICE,
+            "PUT",
+            f"{self.NVR_API_URL}/lessons/{lesson_id}",
+            json=lesson_data,
+            headers={"key": self.NVR_API_KEY},
+        )
+        async with res:
+            await res.json()
 
         if res.status == 200:
             logger.info(f"Lesson with id: {lesson_id} updated")
+            return True
         else:
             logger.error("Erudite is not working properly...")
+            return False
 
     @semlock
     async def get_lesson(self, ruz_lesson_oid: int) -> list:
         """ Gets lesson from Erudite by it's ruz_lesson_oid """
 
-        async with ClientSession() as session:
-            res = await session.get(
-                f"{self.NVR_API_URL}/lessons",
-                params={"ruz_lesson_oid": ruz_lesson_oid, "fromdate": self.dt},
-            )
-            async with res:
-                data = await res.json()
+        res = await send(
+            self.SERVICE,
+            "GET",
+            f"{self.NVR_API_URL}/lessons",
+            params={"ruz_lesson_oid": ruz_lesson_oid, "fromdate": self.dt},
+        )
+        async with res:
+            data = await res.json()
 
         if res.status != 200:
             # This means that there is no such lesson found in Erudite
@@ -125,13 +156,14 @@ class Nvr_Api:
     async def get_lessons_in_room(self, ruz_auditorium_oid: str) -> list:
         """ Gets all lessons from Erudite """
 
-        async with ClientSession() as session:
-            res = await session.get(
-                f"{self.NVR_API_URL}/lessons",
-                params={"ruz_auditorium_oid": ruz_auditorium_oid, "fromdate": self.dt},
-            )
-            async with res:
-                lessons = await res.json()
+        res = await send(
+            self.SERVICE,
+            "GET",
+            f"{self.NVR_API_URL}/lessons",
+            params={"ruz_auditorium_oid": ruz_auditorium_oid, "fromdate": self.dt},
+        )
+        async with res:
+            lessons = await res.json()
 
         if res.status == 200:
             return lessons
@@ -139,57 +171,151 @@ class Nvr_Api:
             logger.info("Lesson not found")
             return []
 
-    @semlock
-    async def delete_copies(self, data: list) -> dict:
-        """ Checks if a list of lessons is longer than 1 and if it is, deletes all but one lessons from the list """
-
-        if len(data) > 1:
-            data_del = data[1:]
-            for i in data_del:
-                await self.delete_lesson(i["id"])
-
-        return data[0]
-
-    @semlock
-    async def check_lesson(self, lesson: dict) -> list:
-        """ Compares two lessons """
-
-        data = await self.get_lesson(lesson["ruz_lesson_oid"])
-
-        # No lesson found in Erudite, so it needs to be added
-        if data is False:
-            return ["Not found"]
-
-        data = await self.delete_copies(data)
+    @staticmethod
+    def compare_lesson(lesson: dict, data: dict) -> list:
+        """ Compares lesson from RUZ with the same lesson from Erudite """
 
+        data = dict(data)  # make copy
         lesson_id = data.pop("id")
         event_id = data.pop("gcalendar_event_id")
         data.pop("gcalendar_calendar_id")
-        if data == lesson:
-            return ["Same"]
+        # Lesson without an event (cleared by purge) is updated, so its event is created again
+        if data == lesson and event_id:
+            return ["Same", lesson_id, event_id]
 
         # If code run up to this point, it means that lesson with such ruz_lesson_oid is found in Erudite, but it differs from the one in RUZ, so it needs to be updated
         return ["Update", lesson_id, event_id]
 
-    @semlock
-    async def check_delete_Erudite_lessons(
-        self, lessons_ruz: list, ruz_auditorium_oid: str
-    ):
-        """ Check all lessons from room in Erudite, if the lesson doesn't exist in RUZ - delete it """
+    async def reconcile_room(
+        self, lessons_ruz: list, ruz_auditorium_oid: str, dates: tuple = None, period_oids: set = None
+    ) -> dict:
+        """
+        Fetches all lessons of the room from Erudite once and compares them with lessons from RUZ
+        Lessons are matched with all Erudite lessons of the room, so a lesson moved from another date is updated
+        dates - (first date, last date) in "%Y-%m-%d" format, if lessons from RUZ cover only a part of the period,
+        only Erudite lessons inside of it are deleted
+        period_oids - ruz_lesson_oid of all lessons in RUZ for the period, they are never deleted
+        Returns a plan:
+            add, update, same - lists of (lesson, check_data),
+                check_data is ["Not found"] or ["Same"/"Update", lesson_id, event_id]
+            delete - lessons from Erudite, that don't exist in RUZ
+            duplicates - extra copies of lessons in Erudite
+        """
 
         lessons_erudite = await self.get_lessons_in_room(ruz_auditorium_oid)
+
+        erudite_index = {}
         for lesson_erudite in lessons_erudite:
-            flag = False
-            for lesson_ruz in lessons_ruz:
-                if lesson_ruz["ruz_lesson_oid"] == lesson_erudite["ruz_lesson_oid"]:
-                    flag = True
-                    break
-                else:
-                    continue
-            if not flag:
-                await self.delete_lesson(lesson_erudite["id"])
-                await self.calendar.delete_event(
-                    lesson_erudite["gcalendar_calendar_id"],
-                    lesson_erudite["gcalendar_event_id"],
+            erudite_index.setdefault(lesson_erudite["ruz_lesson_oid"], []).append(
+                lesson_erudite
+            )
+
+        plan = {"add": [], "update": [], "same": [], "delete": [], "duplicates": []}
+        ruz_lesson_oids = set()
+        for lesson in lessons_ruz:
+            ruz_lesson_oids.add(lesson["ruz_lesson_oid"])
+            data = erudite_index.get(lesson["ruz_lesson_oid"])
+
+            # No lesson found in Erudite, so it needs to be added
+            if not data:
+                plan["add"].append((lesson, ["Not found"]))
+                continue
+
+            plan["duplicates"] += data[1:]
+            check_data = self.compare_lesson(lesson, data[0])
+            if check_data[0] == "Same":
+                plan["same"].append((lesson, check_data))
+            else:
+                plan["update"].append((lesson, check_data))
+
+        if period_oids is not None:
+            ruz_lesson_oids |= period_oids
+        for ruz_lesson_oid, data in erudite_index.items():
+            if ruz_lesson_oid in ruz_lesson_oids:
+                continue
+            plan["delete"] += [
+                lesson_erudite
+                for lesson_erudite in data
+                if dates is None or dates[0] <= lesson_erudite["date"] <= dates[1]
+            ]
+
+        return plan
+
+    async def delete_duplicates(self, lessons_erudite: list):
+        """ Deletes extra copies of lessons from Erudite """
+
+        for lesson_erudite in lessons_erudite:
+            await self.delete_lesson(lesson_erudite["id"])
+
+    async def delete_erudite_lessons(self, lessons_erudite: list) -> list:
+        """
+        Deletes lessons from Erudite together with their events in Google Calendar
+        Lessons are deleted concurrently, the lesson and its event are deleted at the same time
+        Returns list of (lesson, errors) for lessons that could not be deleted completely
+        """
+
+        sem = asyncio.Semaphore(DELETE_CONCURRENCY)
+
+        async def delete(lesson_erudite: dict) -> list:
+            async with sem:
+                return await asyncio.gather(
+                    self.delete_lesson(lesson_erudite["id"]),
+                    self.delete_lesson_event(lesson_erudite),
+                    return_exceptions=True,
+                )
+
+        results = await asyncio.gather(
+            *[delete(lesson_erudite) for lesson_erudite in lessons_erudite]
+        )
+
+        failed = []
+        for lesson_erudite, (lesson_result, event_result) in zip(
+            lessons_erudite, results
+        ):
+            errors = []
+            if lesson_result is not True:
+                errors.append(f"Erudite - {lesson_result}")
+            if event_result is not None:
+                errors.append(f"Google - {event_result}")
+
+            if errors:
+                logger.warning(
+                    f"Lesson with id: {lesson_erudite['id']} was not deleted properly: {'; '.join(errors)}"
                 )
-                time.sleep(0.3)
+                failed.append((lesson_erudite, errors))
+
+        if lessons_erudite:
+            logger.info(
+                f"Deleted {len(lessons_erudite) - len(failed)} of {len(lessons_erudite)} lessons"
+            )
+
+        return failed
+
+    async def clear_event_ids(self, lessons_erudite: list):
+        """ Removes references to Google Calendar events from the lessons in Erudite """
+
+        sem = asyncio.Semaphore(DELETE_CONCURRENCY)
+
+        async def clear(lesson_erudite: dict):
+            lesson_data = dict(lesson_erudite)  # make copy
+            lesson_id = lesson_data.pop("id")
+            lesson_data["gcalendar_event_id"] = ""
+            lesson_data["gcalendar_calendar_id"] = ""
+            async with sem:
+                await self.update_lesson(lesson_id, lesson_data)
+
+        await asyncio.gather(*[clear(lesson_erudite) for lesson_erudite in lessons_erudite])
+        logger.info(f"Event ids cleared in {len(lessons_erudite)} Erudite lessons")
+
+    async def delete_lesson_event(self, lesson_erudite: dict):
+        """ Deletes event of the Erudite lesson, returns None on success and the error of Google otherwise """
+
+        # Lesson could be added to Erudite without an event
+        if not lesson_erudite.get("gcalendar_event_id"):
+            return None
+
+        return await self.calendar.delete_event(
+            lesson_erudite["gcalendar_calendar_id"],
+            lesson_erudite["gcalendar_event_id"],
+            batched=True,
+        )
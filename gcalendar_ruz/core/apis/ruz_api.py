@@ -1,31 +1,38 @@
-from aiohttp import ClientSession
+import asyncio
 from datetime import datetime, timedelta
 
 from loguru import logger
 
-from .nvr_api import Nvr_Api
+from .nvr_api import Nvr_Api, REFERENCE_TTL, REFERENCE_REFRESH_AFTER
 from ..utils import camel_to_snake
-from ..redis_caching.caching import cache
+from ..redis_caching.caching import cache, reference_cache
 from ..utils import semlock, RUZ
 from ..settings import settings
+from .sessions import send
+
+
+# Lessons are kept for 10 minutes, less than the shortest sync interval, so every cycle writes fresh data;
+# they are never returned stale, as the sync writes from them
+LESSONS_TTL = 600
 
 
 class RuzApi:
     SERVICE = RUZ
 
-    def __init__(self, url: str = "http://92.242.58.221/ruzservice.svc"):
-        self.url = url
-        self.nvr_api = Nvr_Api()
+    def __init__(self, nvr_api: Nvr_Api = None, url: str = None):
+        self.url = url or settings.ruz_api_url
+        self.nvr_api = nvr_api or Nvr_Api()
         self.period = settings.period
 
-    # building id МИЭМа = 92
-    @cache
+    @reference_cache(ttl=REFERENCE_TTL, refresh_after=REFERENCE_REFRESH_AFTER)
     @semlock
-    async def get_auditoriumoid(self, building_id: int = 92):
-        async with ClientSession() as session:
-            res = await session.get(f"{self.url}/auditoriums?buildingoid=0")
-            async with res:
-                all_auditories = await res.json()
+    async def get_auditoriumoid(self, building_id: int = None):
+        """ Rooms of the building, settings.ruz_building_id by default """
+
+        building_id = building_id or settings.ruz_building_id
+        res = await send(self.SERVICE, "GET", f"{self.url}/auditoriums?buildingoid=0")
+        async with res:
+            all_auditories = await res.json()
 
         return [
             room
@@ -34,29 +41,148 @@ class RuzApi:
             and room["typeOfAuditorium"] != "Неаудиторные"
         ]
 
-    @cache
-    @semlock
-    async def get_lessons(self, ruz_room_id: str):
+    def period_params(self, from_day: int = 0, to_day: int = None) -> dict:
         """
-        Get lessons in room for a specified period
+        Dates of the synchronized period in RUZ format
+        from_day and to_day are counted from today, by default the whole period is taken
         """
 
-        needed_date = (datetime.today() + timedelta(days=self.period)).strftime(
+        if to_day is None:
+            to_day = self.period
+
+        needed_date = (datetime.today() + timedelta(days=to_day)).strftime(
             "%Y.%m.%d"
         )
-        today = datetime.today().strftime("%Y.%m.%d")
+        today = (datetime.today() + timedelta(days=from_day)).strftime("%Y.%m.%d")
+
+        return dict(fromdate=today, todate=needed_date)
+
+    @cache(ttl=LESSONS_TTL)
+    async def get_lessons(self, ruz_room_id: str, from_day: int = 0, to_day: int = None):
+        """
+        Get lessons in room for a specified period
+        """
+
+        params = dict(self.period_params(from_day, to_day), auditoriumoid=str(ruz_room_id))
+        classes = await self.fetch_lessons(params)
+
+        return await self.normalize_lessons(classes)
+
+    async def get_lessons_in_rooms(
+        self, ruz_room_ids: list, building_id: int = None, from_day: int = 0, to_day: int = None
+    ) -> dict:
+        """
+        Gets lessons of all rooms in the building (settings.ruz_building_id by default) with one request
+        and splits them by room
+        from_day and to_day limit the period, as in period_params
+        Falls back to a request per room, if RUZ can't return lessons of the whole building
+        Returns dict: room id -> lessons (None if lessons of the room could not be got)
+        """
+
+        building_id = building_id or settings.ruz_building_id
+        lessons_by_room = {str(ruz_room_id): [] for ruz_room_id in ruz_room_ids}
 
-        params = dict(
-            fromdate=today, todate=needed_date, auditoriumoid=str(ruz_room_id)
+        classes = None
+        if settings.ruz_bulk_fetch:
+            try:
+                classes = await self.get_building_lessons(building_id, from_day, to_day)
+            except Exception as err:
+                logger.warning(f"Lessons of the building could not be got - {err}")
+
+            # RUZ ignored the building filter, or there are no lessons for our rooms at all
+            if classes is not None and not any(
+                str(class_.get("auditoriumOid")) in lessons_by_room for class_ in classes
+            ):
+                classes = None
+
+        if classes is None:
+            logger.info("Getting lessons room by room")
+
+            # Cached rooms are read with one redis round trip, only the rest are requested
+            cached = await self.get_lessons.read_many(
+                [(self, ruz_room_id, from_day, to_day) for ruz_room_id in ruz_room_ids]
+            )
+            missing = []
+            for ruz_room_id, (found, lessons) in zip(ruz_room_ids, cached):
+                if found:
+                    lessons_by_room[str(ruz_room_id)] = lessons
+                else:
+                    missing.append(ruz_room_id)
+
+            results = await asyncio.gather(
+                *[self.get_lessons(ruz_room_id, from_day, to_day) for ruz_room_id in missing],
+                return_exceptions=True,
+            )
+            for ruz_room_id, lessons in zip(missing, results):
+                if isinstance(lessons, Exception):
+                    logger.error(lessons)
+                    lessons = None
+                lessons_by_room[str(ruz_room_id)] = lessons
+            return lessons_by_room
+
+        classes = [
+            class_ for class_ in classes if str(class_["auditoriumOid"]) in lessons_by_room
+        ]
+        for lesson in await self.normalize_lessons(classes):
+            lessons_by_room[str(lesson["ruz_auditorium_oid"])].append(lesson)
+
+        # Lessons of every room are cached, so requests for a single room don't go to RUZ
+        await self.get_lessons.write_many(
+            [
+                ((self, ruz_room_id, from_day, to_day), lessons_by_room[str(ruz_room_id)])
+                for ruz_room_id in ruz_room_ids
+            ]
         )
 
-        async with ClientSession() as session:
-            res = await session.get(f"{self.url}/lessons", params=params)
-            async with res:
-                res = await res.json(content_type=None)
+        return lessons_by_room
+
+    @cache(ttl=LESSONS_TTL)
+    @semlock
+    async def get_building_lessons(
+        self, building_id: int, from_day: int = 0, to_day: int = None
+    ) -> list:
+        """ Get lessons of the whole building for a specified period, None if RUZ doesn't support it """
+
+        params = dict(self.period_params(from_day, to_day), buildingoid=str(building_id))
+
+        res = await send(self.SERVICE, "GET", f"{self.url}/lessons", params=params)
+        async with res:
+            if res.status != 200:
+                return None
+            classes = await res.json(content_type=None)
+
+        if not isinstance(classes, list) or any(
+            "auditoriumOid" not in class_ for class_ in classes
+        ):
+            return None
+
+        return classes
+
+    @semlock
+    async def fetch_lessons(self, params: dict) -> list:
+        res = await send(self.SERVICE, "GET", f"{self.url}/lessons", params=params)
+        async with res:
+            return await res.json(content_type=None)
+
+    async def normalize_lessons(self, classes: list) -> list:
+        """ Converts lessons from RUZ format to the format of Erudite """
+
+        # Emails of every stream are requested once
+        streams = list({class_["group"].split("#")[0] for class_ in classes if class_["group"] is not None})
+        results = await asyncio.gather(
+            *[self.nvr_api.get_course_emails(stream) for stream in streams], return_exceptions=True
+        )
+        emails_by_stream = {}
+        for stream, emails in zip(streams, results):
+            if isinstance(emails, Exception):
+                # Failed requests are not cached, emails are requested again by the next run
+                logger.error(f"Emails of stream {stream} could not be got, lessons are left without them - {emails}")
+                emails = []
+            emails_by_stream[stream] = emails
 
         lessons = []
-        for class_ in res:
+        for class_ in classes:
+            class_ = dict(class_)  # make copy
             lesson = {}
 
             date = class_.pop("date")
@@ -77,7 +203,7 @@ class RuzApi:
 
             if lesson["ruz_group"] is not None:
                 stream = lesson["ruz_group"].split("#")[0]
-                grp_emails = await self.nvr_api.get_course_emails(stream)
+                grp_emails = emails_by_stream[stream]
                 if grp_emails != []:
                     lesson["grp_emails"] = grp_emails
                 else:
@@ -0,0 +1,163 @@
+from aiohttp import ClientConnectionError, ClientResponse, ClientSession, ClientTimeout, TCPConnector, TraceConfig
+import asyncio
+import time
+from loguru import logger
+
+from .. import metrics
+from ..settings import settings
+from ..utils import (
+    GOOGLE,
+    NVR,
+    RUZ,
+    sem_dict,
+    concurrency_bounds,
+    rate_dict,
+    retry_budgets,
+    breakers,
+    backoff_delay,
+    parse_retry_after,
+    pause_service,
+    RETRY_STATUSES,
+    NOT_PROCESSED_STATUSES,
+)
+
+
+# Connection pool settings per upstream service.
+# Pool sizes follow the upper bounds of the adaptive concurrency limits from utils.concurrency_bounds,
+# so a request that got through the limiter never waits for a free connection.
+connector_settings = {
+    NVR: dict(limit=concurrency_bounds[NVR][1], keepalive_timeout=60),
+    GOOGLE: dict(limit=concurrency_bounds[GOOGLE][1], keepalive_timeout=60),
+    RUZ: dict(limit=concurrency_bounds[RUZ][1], keepalive_timeout=30),
+}
+
+DNS_CACHE_TTL = 300
+REQUEST_TIMEOUT = ClientTimeout(total=60, connect=10)
+
+IDEMPOTENT_METHODS = {"GET", "HEAD", "PUT", "DELETE", "OPTIONS"}
+
+sessions = {}
+
+
+def trace_config(service: str) -> TraceConfig:
+    """
+    Counts requests of the session by status code and measures their latency,
+    results of requests adjust the concurrency limit of the service
+    """
+
+    async def on_request_start(session, context, params):
+        context.started_at = time.monotonic()
+
+    async def on_request_end(session, context, params):
+        latency = time.monotonic() - context.started_at
+        metrics.REQUESTS.inc(service=service, method=params.method, status=params.response.status)
+        metrics.REQUEST_LATENCY.observe(latency, service=service)
+        sem_dict[service].observe(latency, params.response.status)
+
+    async def on_request_exception(session, context, params):
+        latency = time.monotonic() - context.started_at
+        metrics.REQUESTS.inc(service=service, method=params.method, status="error")
+        metrics.REQUEST_LATENCY.observe(latency, service=service)
+        sem_dict[service].observe(latency)
+
+    config = TraceConfig()
+    config.on_request_start.append(on_request_start)
+    config.on_request_end.append(on_request_end)
+    config.on_request_exception.append(on_request_exception)
+    return config
+
+
+def get_session(service: str) -> ClientSession:
+    """ Returns a long-lived session for the service, creating it on first use """
+
+    session = sessions.get(service)
+    if session is None or session.closed:
+        params = connector_settings.get(service)
+        if params is None:
+            logger.error("Unsupported service")
+            params = {}
+
+        connector = TCPConnector(
+            ttl_dns_cache=DNS_CACHE_TTL,
+            enable_cleanup_closed=True,
+            **params,
+        )
+        session = ClientSession(
+            connector=connector, timeout=REQUEST_TIMEOUT, trace_configs=[trace_config(service)]
+        )
+        sessions[service] = session
+
+    return session
+
+
+async def close_sessions():
+    """ Closes all opened sessions, should be called once on shutdown """
+
+    for service, session in list(sessions.items()):
+        if not session.closed:
+            await session.close()
+            logger.info(f"Session for {service} closed")
+    sessions.clear()
+
+
+async def send(
+    service: str, method: str, url: str, idempotent: bool = None, cost: int = 1, **kwargs
+) -> ClientResponse:
+    """
+    Sends a request to the service, repeats it after transient failures
+    and returns the last response, it has to be released by the caller (async with)
+
+    Failures are repeated with jittered exponential backoff, while there are attempts and retry budget left,
+    Retry-After of the service is respected. Requests that are not idempotent (POST by default)
+    are repeated only if the service surely didn't process them.
+    Requests wait while the circuit of the service is open.
+    cost - cost of the request for the rate limit of the service, paid again for every retry
+    """
+
+    if idempotent is None:
+        idempotent = method in IDEMPOTENT_METHODS
+
+    breaker = breakers[service]
+    budget = retry_budgets[service]
+    budget.deposit()
+
+    attempt = 0
+    while True:
+        probe = await breaker.wait()
+        try:
+            res = await get_session(service).request(method, url, **kwargs)
+        except (ClientConnectionError, asyncio.TimeoutError) as err:
+            breaker.failure()
+            attempt += 1
+            if not idempotent or attempt >= settings.retry_max_attempts or not budget.withdraw():
+                raise
+
+            reason = type(err).__name__
+            delay = backoff_delay(attempt)
+        except BaseException:
+            # Cancelled, or the request itself is wrong (invalid url, too many redirects, ...)
+            breaker.abort(probe)
+            raise
+        else:
+            if res.status >= 500:
+                breaker.failure()
+            else:
+                breaker.success()
+
+            retryable = res.status in NOT_PROCESSED_STATUSES or (idempotent and res.status in RETRY_STATUSES)
+            if not retryable or attempt + 1 >= settings.retry_max_attempts or not budget.withdraw():
+                return res
+
+            attempt += 1
+            reason = str(res.status)
+            retry_after = parse_retry_after(res.headers.get("Retry-After"))
+            res.release()
+            if retry_after is not None and res.status == 429:
+                # The whole service asked to slow down, not only this request
+                await pause_service(service, retry_after)
+            delay = max(backoff_delay(attempt), retry_after or 0)
+
+        logger.warning(f"{method} {url} failed ({reason}), retry {attempt} in {delay:.1f} seconds")
+        metrics.RETRIES.inc(service=service, reason=reason)
+        await asyncio.sleep(delay)
+        await rate_dict[service].acquire(cost)
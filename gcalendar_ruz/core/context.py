@@ -0,0 +1,58 @@
+from loguru import logger
+
+from .apis.calendar_api import GCalendar
+from .apis.nvr_api import Nvr_Api
+from .apis.ruz_api import RuzApi
+from .apis.sessions import close_sessions
+from .db.unit_of_work import UnitOfWork
+from .redis_caching.caching import stop_invalidations
+
+
+class AppContext:
+    """
+    Shared clients of the application, every client is created on the first use
+    Importing modules does no work with files, networks or the database, so a mode does only what it needs
+    """
+
+    def __init__(self):
+        self._db = None
+        self._calendar = None
+        self._nvr_api = None
+        self._ruz_api = None
+
+    @property
+    def db(self) -> UnitOfWork:
+        if self._db is None:
+            self._db = UnitOfWork()
+        return self._db
+
+    @property
+    def calendar(self) -> GCalendar:
+        if self._calendar is None:
+            self._calendar = GCalendar()
+        return self._calendar
+
+    @property
+    def nvr_api(self) -> Nvr_Api:
+        if self._nvr_api is None:
+            self._nvr_api = Nvr_Api(self.calendar)
+        return self._nvr_api
+
+    @property
+    def ruz_api(self) -> RuzApi:
+        if self._ruz_api is None:
+            self._ruz_api = RuzApi(self.nvr_api)
+        return self._ruz_api
+
+    async def close(self):
+        """ Closes clients, that were created, and background tasks """
+
+        await close_sessions()
+        await stop_invalidations()
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+            logger.info("Database thread stopped")
+
+
+app = AppContext()
@@ -0,0 +1,46 @@
+from loguru import logger
+
+from .models import Room, OnlineRoom, User
+
+
+class LookupIndex:
+    """
+    Rooms, users and online rooms loaded once per run, so lessons are processed without database reads
+    Only needed columns are queried, so sources of rooms are not loaded
+    Rows support attribute access: room.id, room.calendar, ...
+    """
+
+    def __init__(self, db):
+        self.db = db
+        self.rooms_by_name = {}
+        self.rooms_by_ruz_id = {}
+        self.users_by_email = {}
+        self.online_rooms_by_name = {}
+
+    async def refresh(self):
+        rooms, users, online_rooms = await self.db.run(load_index)
+
+        self.rooms_by_name = {room.name: room for room in rooms}
+        self.rooms_by_ruz_id = {room.ruz_id: room for room in rooms if room.ruz_id is not None}
+        self.users_by_email = {user.email: user for user in users}
+        self.online_rooms_by_name = {room.name: room for room in online_rooms}
+
+        logger.info(
+            f"Loaded {len(rooms)} rooms, {len(users)} users and {len(online_rooms)} online rooms"
+        )
+
+    def room(self, name: str):
+        return self.rooms_by_name.get(name)
+
+    def user(self, email: str):
+        return self.users_by_email.get(email)
+
+    def online_room(self, name: str):
+        return self.online_rooms_by_name.get(name)
+
+
+def load_index(session) -> tuple:
+    rooms = session.query(Room.id, Room.name, Room.ruz_id, Room.calendar).all()
+    users = session.query(User.id, User.email).all()
+    online_rooms = session.query(OnlineRoom.id, OnlineRoom.name, OnlineRoom.calendar).all()
+    return rooms, users, online_rooms
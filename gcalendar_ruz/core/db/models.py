@@ -16,8 +16,24 @@ from ..settings import settings
 
 
 Base = declarative_base()
-engine = create_engine(settings.db_url)
-Session = sessionmaker(bind=engine)
+Session = sessionmaker()
+engine = None
+
+
+def get_engine():
+    """ Engine is created by the first use, so importing models doesn't connect to the database """
+
+    global engine
+    if engine is None:
+        engine = create_engine(
+            settings.db_url,
+            pool_size=settings.db_pool_size,
+            max_overflow=settings.db_max_overflow,
+            pool_recycle=settings.db_pool_recycle,
+            pool_pre_ping=True,
+        )
+        Session.configure(bind=engine)
+    return engine
 
 
 class IdMixin:
@@ -120,3 +136,17 @@ class User(Base, CommonMixin):
     last_login = Column(DateTime, default=datetime.utcnow)
 
     records = relationship("UserRecord", back_populates="user")
+
+
+class LessonSyncState(Base, CommonMixin):
+    """ What was synchronized for a RUZ lesson during the previous runs """
+
+    __tablename__ = "lesson_sync_states"
+
+    ruz_lesson_oid = Column(Integer, nullable=False, unique=True)
+    ruz_auditorium_oid = Column(String(100), index=True)
+    date = Column(String(100))
+    erudite_lesson_id = Column(String(100))
+    gcalendar_event_id = Column(String(200))
+    gcalendar_calendar_id = Column(String(200))
+    fingerprint = Column(String(64), nullable=False)
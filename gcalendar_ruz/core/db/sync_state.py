@@ -0,0 +1,135 @@
+from datetime import datetime
+from loguru import logger
+
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.sql.expression import func
+
+from .models import LessonSyncState
+from ..utils import lesson_fingerprint
+
+
+STATE_COLUMNS = (
+    "ruz_lesson_oid",
+    "ruz_auditorium_oid",
+    "date",
+    "erudite_lesson_id",
+    "gcalendar_event_id",
+    "gcalendar_calendar_id",
+    "fingerprint",
+)
+
+
+class SyncStateStore:
+    """
+    Keeps fingerprints of synchronized lessons, so unchanged lessons are skipped without any requests
+    All states are loaded once and then looked up in memory, changes are written in bulk by commit
+    """
+
+    def __init__(self, db):
+        self.db = db
+        self.states = {}
+        self.changed = {}
+        self.removed = set()
+
+    async def create_table(self):
+        """ Creates the table of sync states if it doesn't exist, it is done once at startup """
+
+        await self.db.run(create_states_table)
+
+    async def load(self):
+        rows = await self.db.run(load_states)
+        self.states = {row["ruz_lesson_oid"]: row for row in rows}
+        self.changed = {}
+        self.removed = set()
+        logger.info(f"Loaded sync state of {len(self.states)} lessons")
+
+    def is_unchanged(self, lesson: dict) -> bool:
+        state = self.states.get(lesson["ruz_lesson_oid"])
+        return state is not None and state["fingerprint"] == lesson_fingerprint(lesson)
+
+    def stale_in_room(self, ruz_auditorium_oid: str, lessons: list, dates: tuple = None) -> list:
+        """
+        States of upcoming lessons in the room, that are not in RUZ anymore
+        dates - (first date, last date), if lessons cover only a part of the period
+        """
+
+        if dates is None:
+            dates = (datetime.today().strftime("%Y-%m-%d"), "9999-12-31")
+
+        ruz_lesson_oids = {lesson["ruz_lesson_oid"] for lesson in lessons}
+        return [
+            state
+            for state in self.states.values()
+            if state["ruz_auditorium_oid"] == str(ruz_auditorium_oid)
+            and state["ruz_lesson_oid"] not in ruz_lesson_oids
+            and dates[0] <= state["date"] <= dates[1]
+        ]
+
+    def save(self, lesson: dict, erudite_lesson_id, event_id: str, calendar_id: str):
+        state = dict(
+            ruz_lesson_oid=lesson["ruz_lesson_oid"],
+            ruz_auditorium_oid=str(lesson["ruz_auditorium_oid"]),
+            date=lesson["date"],
+            erudite_lesson_id=str(erudite_lesson_id),
+            gcalendar_event_id=event_id,
+            gcalendar_calendar_id=calendar_id,
+            fingerprint=lesson_fingerprint(lesson),
+        )
+        if self.states.get(state["ruz_lesson_oid"]) == state:
+            return
+
+        self.states[state["ruz_lesson_oid"]] = state
+        self.changed[state["ruz_lesson_oid"]] = state
+        self.removed.discard(state["ruz_lesson_oid"])
+
+    def remove(self, ruz_lesson_oids: list):
+        for ruz_lesson_oid in ruz_lesson_oids:
+            self.changed.pop(ruz_lesson_oid, None)
+            if self.states.pop(ruz_lesson_oid, None) is not None:
+                self.removed.add(ruz_lesson_oid)
+
+    def remove_calendars(self, calendar_ids: list):
+        """ Forgets all lessons, which events are in the calendars """
+
+        self.remove(
+            [
+                state["ruz_lesson_oid"]
+                for state in self.states.values()
+                if state["gcalendar_calendar_id"] in calendar_ids
+            ]
+        )
+
+    async def commit(self):
+        if not self.changed and not self.removed:
+            return
+
+        changed, self.changed = list(self.changed.values()), {}
+        removed, self.removed = list(self.removed), set()
+        await self.db.run(write_states, changed, removed)
+
+
+def create_states_table(session):
+    LessonSyncState.__table__.create(bind=session.get_bind(), checkfirst=True)
+
+
+def load_states(session) -> list:
+    columns = [getattr(LessonSyncState, column) for column in STATE_COLUMNS]
+    return [dict(zip(STATE_COLUMNS, row)) for row in session.query(*columns)]
+
+
+def write_states(session, changed: list, removed: list):
+    if changed:
+        statement = insert(LessonSyncState.__table__).values(changed)
+        statement = statement.on_conflict_do_update(
+            index_elements=[LessonSyncState.ruz_lesson_oid],
+            set_=dict(
+                {column: statement.excluded[column] for column in STATE_COLUMNS[1:]},
+                modified_at=func.now(),
+            ),
+        )
+        session.execute(statement)
+
+    if removed:
+        session.query(LessonSyncState).filter(
+            LessonSyncState.ruz_lesson_oid.in_(removed)
+        ).delete(synchronize_session=False)
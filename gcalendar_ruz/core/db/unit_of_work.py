@@ -0,0 +1,111 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from loguru import logger
+
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.sql.expression import func
+
+from .models import Session, Record, UserRecord, get_engine
+
+
+class UnitOfWork:
+    """
+    Runs database work in a dedicated thread, so the event loop is never blocked by the database
+    New records are accumulated in memory and written in bulk by flush_records
+    """
+
+    def __init__(self, max_workers: int = 1):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="db")
+        self.records = []
+
+    async def run(self, work, *args):
+        """
+        Runs work(session, *args) in the database thread in its own session and commits it
+        Objects loaded by work can still be read after it is done
+        """
+
+        def job():
+            get_engine()
+            session = Session(expire_on_commit=False)
+            try:
+                result = work(session, *args)
+                session.commit()
+                return result
+            except Exception:
+                session.rollback()
+                raise
+            finally:
+                session.close()
+
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, job)
+
+    def add_record(self, room_id: int, creator_id: int, event: dict):
+        """ Remembers a record for the event in the room, it is written on the next flush """
+
+        start_date = event["start"]["dateTime"].split("T")[0]
+        end_date = event["end"]["dateTime"].split("T")[0]
+
+        if start_date != end_date:
+            return
+
+        self.records.append((room_id, creator_id, event))
+
+    async def flush_records(self):
+        if not self.records:
+            return
+
+        records, self.records = self.records, []
+        count = await self.run(write_records, records)
+        logger.info(f"{count} records saved")
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+
+
+def write_records(session, records: list) -> int:
+    """ Upserts records by event_id and links them to the creators of events """
+
+    rows = {}
+    creators = {}
+    for room_id, creator_id, event in records:
+        record = Record()
+        record.update_from_calendar(**event)
+        rows[record.event_id] = dict(
+            date=record.date,
+            start_time=record.start_time,
+            end_time=record.end_time,
+            event_name=record.event_name,
+            event_id=record.event_id,
+            room_id=room_id,
+        )
+        creators[record.event_id] = creator_id
+
+    if not rows:
+        return 0
+
+    statement = insert(Record.__table__).values(list(rows.values()))
+    statement = statement.on_conflict_do_update(
+        index_elements=[Record.event_id],
+        set_=dict(
+            date=statement.excluded.date,
+            start_time=statement.excluded.start_time,
+            end_time=statement.excluded.end_time,
+            event_name=statement.excluded.event_name,
+            room_id=statement.excluded.room_id,
+            modified_at=func.now(),
+        ),
+    ).returning(Record.id, Record.event_id)
+    record_ids = dict((event_id, record_id) for record_id, event_id in session.execute(statement))
+
+    user_records = [
+        dict(user_id=creators[event_id], record_id=record_id)
+        for event_id, record_id in record_ids.items()
+    ]
+    session.execute(
+        insert(UserRecord.__table__).values(user_records).on_conflict_do_nothing(
+            index_elements=[UserRecord.user_id, UserRecord.record_id]
+        )
+    )
+
+    return len(rows)
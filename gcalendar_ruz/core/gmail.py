@@ -18,8 +18,9 @@ class Gmail_info(BaseSettings):
 class Gmail:
     def __init__(self) -> None:
         self.server = None
-        self.password = self.get_password()
-        self.gmail = self.get_gmail()
+        gmail_info = Gmail_info(_env_file="../.env")
+        self.password = gmail_info.gmail_password
+        self.gmail = gmail_info.gmail
         if self.password is None:
             logger.warning("Password not found, alert can't be done")
         if self.gmail is None:
@@ -29,16 +30,6 @@ class Gmail:
         if self.server:
             self.server.close()
 
-    def get_password(self) -> str or None:
-        gmail_info = Gmail_info(_env_file="../.env")
-        password = gmail_info.gmail_password
-        return password
-
-    def get_gmail(self) -> str or None:
-        gmail_info = Gmail_info(_env_file="../.env")
-        mail = gmail_info.gmail
-        return mail
-
     def start_server(self) -> None:
         try:
             self.server = smtplib.SMTP("smtp.gmail.com", 587)
@@ -69,7 +60,16 @@ class Gmail:
                 logger.info("Gmail sent")
 
 
-gmail = Gmail()
+gmail = None
+
+
+def get_gmail() -> Gmail:
+    """ Gmail is set up by the first alert, so importing the module doesn't read the env file """
+
+    global gmail
+    if gmail is None:
+        gmail = Gmail()
+    return gmail
 
 
 def alert_async(func):
@@ -78,8 +78,8 @@ def alert_async(func):
         try:
             await func(*args, **kwargs)
         except Exception as error:
-            message = gmail.create_message(error)
-            gmail.send_gmail_to_myself(message)
+            message = get_gmail().create_message(error)
+            get_gmail().send_gmail_to_myself(message)
             raise Exception
 
     return wrapper
@@ -91,8 +91,8 @@ def alert_sync(func):
         try:
             func(*args, **kwargs)
         except Exception as error:
-            message = gmail.create_message(error)
-            gmail.send_gmail_to_myself(message)
+            message = get_gmail().create_message(error)
+            get_gmail().send_gmail_to_myself(message)
             raise Exception
 
     return wrapper
@@ -0,0 +1,76 @@
+from datetime import datetime, timedelta
+from typing import NamedTuple, Optional
+import time
+
+from loguru import logger
+
+
+# Cycles are started by timers, that can fire a bit earlier, so a horizon is due slightly before its interval ends
+SCHEDULE_SLACK = 1
+
+
+class Horizon(NamedTuple):
+    """
+    Part of the synchronized period: days from_day..to_day counted from today,
+    synchronized every `interval` seconds
+    """
+
+    name: str
+    from_day: int
+    to_day: int
+    interval: int
+
+    def dates(self) -> tuple:
+        """ First and last date of the horizon in "%Y-%m-%d" format """
+
+        today = datetime.today()
+        return (
+            (today + timedelta(days=self.from_day)).strftime("%Y-%m-%d"),
+            (today + timedelta(days=self.to_day)).strftime("%Y-%m-%d"),
+        )
+
+
+def parse_horizons(spec: str, period: int) -> list:
+    """
+    Builds horizons from a spec like "1:900,7:3600,period:21600" - last day of the horizon and its interval,
+    horizons follow each other and are cut by the period, if the spec doesn't reach the period,
+    the rest of it is synchronized with the interval of the last horizon
+    """
+
+    horizons = []
+    from_day = 0
+    for part in spec.split(","):
+        last_day, _, interval = part.strip().partition(":")
+        last_day = period if last_day == "period" else min(int(last_day), period)
+        if last_day < from_day:
+            continue
+
+        horizons.append(Horizon(f"days {from_day}-{last_day}", from_day, last_day, int(interval)))
+        from_day = last_day + 1
+
+    if from_day <= period:
+        interval = horizons[-1].interval if horizons else 0
+        horizons.append(Horizon(f"days {from_day}-{period}", from_day, period, interval))
+
+    return horizons
+
+
+class HorizonScheduler:
+    """ Decides which horizons have to be synchronized now, nearest horizons come first """
+
+    def __init__(self, horizons: list):
+        self.horizons = sorted(horizons, key=lambda horizon: horizon.from_day)
+        self.last_run = {}
+
+    def due(self, now: Optional[float] = None) -> list:
+        now = time.monotonic() if now is None else now
+        return [
+            horizon
+            for horizon in self.horizons
+            if horizon.name not in self.last_run
+            or now - self.last_run[horizon.name] >= horizon.interval - SCHEDULE_SLACK
+        ]
+
+    def mark_done(self, horizon: Horizon, started_at: float):
+        self.last_run[horizon.name] = started_at
+        logger.info(f"Horizon {horizon.name} synchronized")
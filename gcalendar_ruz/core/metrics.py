@@ -0,0 +1,234 @@
+from aiohttp import web
+from loguru import logger
+
+
+# Upper bounds of latency buckets in seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+registry = []
+
+
+class Counter:
+    """ Monotonic counter with labels """
+
+    kind = "counter"
+
+    def __init__(self, name: str, description: str, labels: tuple = ()):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self.values = {}
+        registry.append(self)
+
+    def inc(self, value: float = 1, **labels):
+        key = tuple(str(labels.get(label, "")) for label in self.labels)
+        self.values[key] = self.values.get(key, 0) + value
+
+    def samples(self) -> list:
+        return [(self.name, key, value) for key, value in self.values.items()]
+
+    def snapshot(self) -> dict:
+        return dict(self.values)
+
+
+class Gauge:
+    """ Current value with labels """
+
+    kind = "gauge"
+
+    def __init__(self, name: str, description: str, labels: tuple = ()):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self.values = {}
+        registry.append(self)
+
+    def set(self, value: float, **labels):
+        key = tuple(str(labels.get(label, "")) for label in self.labels)
+        self.values[key] = value
+
+    def samples(self) -> list:
+        return [(self.name, key, value) for key, value in self.values.items()]
+
+    def snapshot(self) -> dict:
+        return {}
+
+
+class Histogram:
+    """ Distribution of observed values with labels, in prometheus buckets """
+
+    kind = "histogram"
+
+    def __init__(self, name: str, description: str, labels: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self.buckets = buckets
+        self.values = {}
+        registry.append(self)
+
+    def observe(self, value: float, **labels):
+        key = tuple(str(labels.get(label, "")) for label in self.labels)
+        state = self.values.get(key)
+        if state is None:
+            state = self.values[key] = {"buckets": [0] * len(self.buckets), "count": 0, "sum": 0.0}
+
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                state["buckets"][index] += 1
+        state["count"] += 1
+        state["sum"] += value
+
+    def samples(self) -> list:
+        samples = []
+        for key, state in self.values.items():
+            for bound, count in zip(self.buckets, state["buckets"]):
+                samples.append((f"{self.name}_bucket", key + (("le", str(bound)),), count))
+            samples.append((f"{self.name}_bucket", key + (("le", "+Inf"),), state["count"]))
+            samples.append((f"{self.name}_count", key, state["count"]))
+            samples.append((f"{self.name}_sum", key, state["sum"]))
+        return samples
+
+    def snapshot(self) -> dict:
+        return {key: (state["count"], state["sum"]) for key, state in self.values.items()}
+
+
+REQUESTS = Counter(
+    "gcalendar_http_requests_total", "HTTP requests to services by status code", ("service", "method", "status")
+)
+REQUEST_LATENCY = Histogram("gcalendar_http_request_seconds", "Latency of HTTP requests to services", ("service",))
+CALL_LATENCY = Histogram(
+    "gcalendar_api_call_seconds", "Duration of API methods after they got a service slot", ("service", "operation")
+)
+SLOT_WAIT = Histogram(
+    "gcalendar_slot_wait_seconds", "Time spent waiting for the semaphore and rate limit of a service", ("service",)
+)
+RETRIES = Counter("gcalendar_retries_total", "Requests repeated after an error of a service", ("service", "reason"))
+CIRCUIT_OPENS = Counter("gcalendar_circuit_opens_total", "How many times circuits of services opened", ("service",))
+TOKEN_REFRESHES = Counter("gcalendar_token_refreshes_total", "Refreshes of Google credentials")
+CONCURRENCY_LIMIT = Gauge(
+    "gcalendar_concurrency_limit", "Current adaptive limit of concurrent requests to a service", ("service",)
+)
+CACHE_REQUESTS = Counter(
+    "gcalendar_cache_requests_total",
+    "Calls of cached functions by result: local, redis, stale or miss",
+    ("function", "result"),
+)
+
+
+def format_labels(names: tuple, key: tuple) -> str:
+    pairs = [f'{name}="{value}"' for name, value in zip(names, key)]
+    pairs += [f'{name}="{value}"' for name, value in key[len(names):]]
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def render() -> str:
+    """ All metrics in prometheus text format """
+
+    lines = []
+    for metric in registry:
+        lines.append(f"# HELP {metric.name} {metric.description}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        for name, key, value in metric.samples():
+            lines.append(f"{name}{format_labels(metric.labels, key)} {value}")
+    return "\n".join(lines) + "\n"
+
+
+def snapshot() -> dict:
+    """ Current values of all metrics, summary shows what changed since a snapshot """
+
+    return {metric.name: metric.snapshot() for metric in registry}
+
+
+def changes(metric, since: dict) -> dict:
+    before = since.get(metric.name, {})
+    result = {}
+    for key, value in metric.snapshot().items():
+        old = before.get(key)
+        if isinstance(value, tuple):
+            old = old or (0, 0.0)
+            value = (value[0] - old[0], value[1] - old[1])
+            if value[0]:
+                result[key] = value
+        else:
+            value = value - (old or 0)
+            if value:
+                result[key] = value
+    return result
+
+
+def summary(since: dict = None) -> list:
+    """ Human readable lines about requests, waiting and cache since the snapshot (or since start) """
+
+    since = since or {}
+    lines = []
+
+    requests = changes(REQUESTS, since)
+    latency = changes(REQUEST_LATENCY, since)
+    waits = changes(SLOT_WAIT, since)
+    services = sorted({key[0] for key in requests} | {key[0] for key in waits})
+    for service in services:
+        total = sum(value for key, value in requests.items() if key[0] == service)
+        errors = sum(
+            value
+            for key, value in requests.items()
+            if key[0] == service and (key[2] == "error" or int(key[2]) >= 400)
+        )
+        statuses = ", ".join(
+            f"{key[2]}: {int(value)}" for key, value in sorted(requests.items()) if key[0] == service
+        )
+        count, seconds = latency.get((service,), (0, 0.0))
+        wait_count, wait_seconds = waits.get((service,), (0, 0.0))
+        lines.append(
+            f"{service}: {int(total)} requests ({statuses}), {int(errors)} errors, "
+            f"mean latency {seconds / count if count else 0:.3f}s, "
+            f"waited for slots {wait_seconds:.1f}s in total "
+            f"({wait_seconds / wait_count if wait_count else 0:.3f}s mean)"
+        )
+
+    for (service, reason), value in sorted(changes(RETRIES, since).items()):
+        lines.append(f"{service}: {int(value)} retries because of {reason}")
+
+    for (service,), value in sorted(changes(CIRCUIT_OPENS, since).items()):
+        lines.append(f"{service}: circuit opened {int(value)} times")
+
+    refreshes = changes(TOKEN_REFRESHES, since)
+    if refreshes:
+        lines.append(f"google: {int(sum(refreshes.values()))} token refreshes")
+
+    if CONCURRENCY_LIMIT.values:
+        limits = ", ".join(f"{key[0]}: {value}" for key, value in sorted(CONCURRENCY_LIMIT.values.items()))
+        lines.append(f"concurrency limits - {limits}")
+
+    cache_requests = changes(CACHE_REQUESTS, since)
+    for function in sorted({key[0] for key in cache_requests}):
+        results = {key[1]: value for key, value in cache_requests.items() if key[0] == function}
+        total = sum(results.values())
+        hits = total - results.get("miss", 0)
+        details = ", ".join(f"{result}: {int(value)}" for result, value in sorted(results.items()))
+        lines.append(f"cache {function}: hit ratio {hits / total:.0%} ({details})")
+
+    return lines
+
+
+def log_summary(since: dict = None):
+    lines = summary(since)
+    if not lines:
+        return
+
+    logger.info("Run summary:\n" + "\n".join(lines))
+
+
+async def serve(port: int, host: str = "0.0.0.0") -> web.AppRunner:
+    """ Starts the /metrics endpoint, returned runner has to be cleaned up on shutdown """
+
+    async def handle(request):
+        return web.Response(text=render(), content_type="text/plain", charset="utf-8")
+
+    app = web.Application()
+    app.router.add_get("/metrics", handle)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logger.info(f"Metrics are served on {host}:{port}/metrics")
+    return runner
@@ -1,31 +1,74 @@
 from aredis import StrictRedis
 from datetime import timedelta
-import json
+from uuid import uuid4
+import asyncio
+import time
 from functools import wraps
 from loguru import logger
 
+from .. import metrics
 from ..settings import settings
+from .local_cache import LocalCache
+from .codec import CacheCodec
 
 
 URL = settings.url_redis
+client = None
+
+# In-process results of reference_cache functions, one dict per decorated function
+reference_memos = []
+
+# How often a worker checks, if other worker already got the data it waits for
+LOCK_POLL_INTERVAL = 0.1
+
+# Entries of the cache decorator are stored in redis in compact binary form
+codec = CacheCodec(compress_threshold=settings.cache_compress_threshold)
+
+# Decoded values are kept in memory of the process in front of redis,
+# processes tell each other about rewritten keys through the channel
+local_cache = LocalCache(settings.local_cache_max_bytes)
+INVALIDATION_CHANNEL = "cache_invalidation"
+# Failed listener of invalidations is restarted after a delay, that doubles up to the maximum
+INVALIDATION_RETRY_DELAY = 1
+INVALIDATION_RETRY_MAX_DELAY = 60
+PROCESS_ID = uuid4().hex
+invalidation_task = None
 
 
 async def redis_connect() -> StrictRedis:
     """ Connecting with redis """
 
-    global client
+    global client, invalidation_task
 
     try:
         client = StrictRedis.from_url(URL)
         ping = await client.ping()
         if ping is True:
             logger.info("Connection with redis successful")
+            if invalidation_task is None or invalidation_task.done():
+                invalidation_task = asyncio.ensure_future(listen_invalidations())
             return client
     except Exception:
         logger.error("Connection with redis failed")
         client = None
 
 
+async def stop_invalidations():
+    """ Stops listening to cache invalidations, called on shutdown """
+
+    global invalidation_task
+
+    if invalidation_task is None:
+        return
+
+    invalidation_task.cancel()
+    try:
+        await invalidation_task
+    except asyncio.CancelledError:
+        pass
+    invalidation_task = None
+
+
 async def get_routes_from_cache(key: str) -> str:
     """ Get data from redis """
 
@@ -33,39 +76,372 @@ async def get_routes_from_cache(key: str) -> str:
     return value
 
 
-async def set_routes_to_cache(key: str, value: str) -> bool:
-    """ Set data to redis """
+async def set_routes_to_cache(key: str, value: str, ttl: int = 600) -> bool:
+    """ Set data to redis, value without ttl is kept until it is rewritten """
 
-    state = await client.setex(key, timedelta(seconds=600), value=value)
+    if ttl is None:
+        return await client.set(key, value)
+
+    state = await client.setex(key, timedelta(seconds=ttl), value=value)
     return state
 
 
-def cache(func):
+async def delete_routes_from_cache(key: str) -> int:
+    """ Delete data from redis """
+
+    return await client.delete(key)
+
+
+async def get_many_from_cache(keys: list) -> list:
+    """ Get data for many keys from redis in one round trip """
+
+    if not keys:
+        return []
+
+    async with await client.pipeline(transaction=False) as pipe:
+        for key in keys:
+            await pipe.get(key)
+        return await pipe.execute()
+
+
+async def set_many_to_cache(items: list) -> list:
+    """ Set data for many keys to redis in one round trip, items - list of (key, value, ttl) """
+
+    if not items:
+        return []
+
+    async with await client.pipeline(transaction=False) as pipe:
+        for key, value, ttl in items:
+            await pipe.setex(key, timedelta(seconds=ttl), value)
+        return await pipe.execute()
+
+
+def make_cache_key(func, args: tuple, kwargs: dict) -> str:
+    """ Key for the function call, first argument (self) is skipped """
+
+    return f"{func.__name__}({args[1:]}, {kwargs})"
+
+
+async def listen_invalidations():
+    """
+    Removes keys rewritten by other processes from the local cache
+    While the listener is down, the local cache is disabled, the listener is restarted with backoff
+    """
+
+    delay = INVALIDATION_RETRY_DELAY
+    while True:
+        try:
+            pubsub = client.pubsub()
+            await pubsub.subscribe(INVALIDATION_CHANNEL)
+            if not local_cache.enabled:
+                logger.info("Listening to cache invalidations restored, local cache is enabled")
+                local_cache.enable()
+            delay = INVALIDATION_RETRY_DELAY
+
+            while True:
+                message = await pubsub.get_message(timeout=1)
+                if not message or message["type"] != "message":
+                    continue
+
+                sender, _, cache_key = message["data"].decode().partition(":")
+                if sender != PROCESS_ID:
+                    local_cache.invalidate(cache_key)
+        except asyncio.CancelledError:
+            raise
+        except Exception as err:
+            # Without invalidations other processes' writes can't be seen, so local values are not trusted
+            logger.error(f"Listening to cache invalidations failed, local cache is disabled - {err}")
+            local_cache.disable()
+
+        await asyncio.sleep(delay)
+        delay = min(delay * 2, INVALIDATION_RETRY_MAX_DELAY)
+
+
+async def read_entry(cache_key: str) -> tuple:
+    """
+    Gets cache entry {"stored_at": timestamp, "value": data} from redis
+    Returns (entry, uncompressed size of the entry in bytes), entry is None if there is no valid entry
+    """
+
+    data = await get_routes_from_cache(cache_key)
+    return decode_entry(data)
+
+
+def decode_entry(data: bytes) -> tuple:
+    """ Returns (entry, uncompressed size of the entry in bytes), entry is None if data is not a valid entry """
+
+    if not data:
+        return None, 0
+
+    try:
+        entry, size = codec.decode_sized(data)
+    except ValueError:
+        return None, 0
+
+    if not isinstance(entry, dict) or "stored_at" not in entry:
+        return None, 0
+    return entry, size
+
+
+async def wait_for_entry(cache_key: str, lock_key: str, timeout: int) -> dict:
+    """ Waits while other worker gets the data, returns None if it failed or took too long """
+
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        await asyncio.sleep(LOCK_POLL_INTERVAL)
+
+        entry, _ = await read_entry(cache_key)
+        if entry is not None:
+            return entry
+        if not await client.exists(lock_key):
+            return None
+
+    return None
+
+
+def cache(
+    func=None,
+    *,
+    ttl: int = 600,
+    stale_ttl: int = 0,
+    negative_ttl: int = 60,
+    lock_timeout: int = 30,
+):
+    """
+    Caches results of a coroutine in redis, can be used as @cache or @cache(ttl=...)
+
+    ttl - for how many seconds the value is fresh
+    stale_ttl - for how many seconds after ttl the old value is still returned, while it is refreshed in background
+    negative_ttl - for how many seconds None result is kept, so failing lookups are not repeated on every call
+    lock_timeout - for how long other workers wait for the worker, that is getting the same data
+
+    Concurrent calls with the same key send one request:
+    inside the process they share one task, between processes only the owner of the redis lock sends it
+    """
+
+    if func is None:
+        return lambda func: cache(
+            func,
+            ttl=ttl,
+            stale_ttl=stale_ttl,
+            negative_ttl=negative_ttl,
+            lock_timeout=lock_timeout,
+        )
+
+    inflight = {}
+
+    def remember(cache_key: str, entry: dict, size: int):
+        """ Keeps the entry in the local cache while it is fresh """
+
+        fresh_for = negative_ttl if entry["value"] is None else ttl
+        local_cache.set(cache_key, entry, size, entry["stored_at"] + fresh_for)
+
+    async def store(cache_key: str, data):
+        expire = negative_ttl if data is None else ttl + stale_ttl
+        if expire <= 0:
+            return
+
+        entry = {"stored_at": time.time(), "value": data}
+        dump, size = codec.encode_sized(entry)
+        remember(cache_key, entry, size)
+
+        if client:
+            await set_routes_to_cache(cache_key, dump, ttl=expire)
+            await client.publish(INVALIDATION_CHANNEL, f"{PROCESS_ID}:{cache_key}")
+
+    def use_entry(cache_key: str, entry: dict, size: int, args: tuple, kwargs: dict):
+        """ Returns value of the entry from redis, stale values are refreshed in background """
+
+        age = time.time() - entry["stored_at"]
+        if entry["value"] is not None and age > ttl:
+            single_flight(cache_key, args, kwargs, background=True)
+        else:
+            remember(cache_key, entry, size)
+        return entry["value"]
+
+    def count_entry(entry: dict):
+        stale = entry["value"] is not None and time.time() - entry["stored_at"] > ttl
+        metrics.CACHE_REQUESTS.inc(function=func.__qualname__, result="stale" if stale else "redis")
+
+    async def fetch(cache_key: str, args: tuple, kwargs: dict, background: bool):
+        lock_key = f"lock:{cache_key}"
+        locked = True
+        if client:
+            locked = await client.set(lock_key, "1", ex=lock_timeout, nx=True)
+
+        if not locked:
+            # Other worker refreshes the value, stale value is good enough for now
+            if background:
+                return None
+
+            entry = await wait_for_entry(cache_key, lock_key, lock_timeout)
+            if entry is not None:
+                logger.info("Getting data from cach")
+                return entry["value"]
+
+        try:
+            logger.info("Getting data from remote source")
+            data = await func(*args, **kwargs)
+
+            await store(cache_key, data)
+        finally:
+            if client and locked:
+                await client.delete(lock_key)
+
+        return data
+
+    def single_flight(cache_key: str, args: tuple, kwargs: dict, background: bool = False):
+        # Background refresh may give up, so callers waiting for data never join it
+        inflight_key = (cache_key, background)
+        task = inflight.get(inflight_key)
+        if task is not None:
+            return task
+
+        task = asyncio.ensure_future(fetch(cache_key, args, kwargs, background))
+        inflight[inflight_key] = task
+
+        def done(task):
+            if inflight.get(inflight_key) is task:
+                del inflight[inflight_key]
+            if not task.cancelled() and task.exception() and background:
+                logger.error(f"Background refresh of {cache_key} failed - {task.exception()}")
+
+        task.add_done_callback(done)
+        return task
+
     @wraps(func)
-    async def wrapper(*args, **kwargs) -> dict:
+    async def wrapper(*args, **kwargs):
         """
         Checks if info with given key is in redis
         If it is, returns data, if not, sends a request
         """
 
+        cache_key = make_cache_key(func, args, kwargs)
+
+        # Hot keys are served from memory without any I/O
+        entry = local_cache.get(cache_key)
+        if entry is not None:
+            metrics.CACHE_REQUESTS.inc(function=func.__qualname__, result="local")
+            return entry["value"]
+
         if client:
-            cache_key = f"{func.__name__}({args[1:]}, {kwargs})"
-            data = await get_routes_from_cache(cache_key)
+            entry, size = await read_entry(cache_key)
 
-            if data:
+            if entry is not None:
                 logger.info("Getting data from cach")
-                data = json.loads(data)
-                return data
+                count_entry(entry)
+                return use_entry(cache_key, entry, size, args, kwargs)
 
-        logger.info("Getting data from remote source")
-        data = await func(*args, **kwargs)
+        metrics.CACHE_REQUESTS.inc(function=func.__qualname__, result="miss")
+        return await asyncio.shield(single_flight(cache_key, args, kwargs))
 
-        if data is None:
-            return None
+    async def read_many(calls: list) -> list:
+        """
+        Reads cached values for many calls with one redis round trip, nothing is requested from the source
+        calls - list of args tuples (self included)
+        Returns list of (found, value)
+        """
 
-        if client:
-            await set_routes_to_cache(key=cache_key, value=json.dumps(data))
+        results = [(False, None)] * len(calls)
+        keys = [make_cache_key(func, args, {}) for args in calls]
 
-        return data
+        missing = []
+        for index, cache_key in enumerate(keys):
+            entry = local_cache.get(cache_key)
+            if entry is not None:
+                metrics.CACHE_REQUESTS.inc(function=func.__qualname__, result="local")
+                results[index] = (True, entry["value"])
+            else:
+                missing.append(index)
+
+        if client and missing:
+            datas = await get_many_from_cache([keys[index] for index in missing])
+            for index, data in zip(missing, datas):
+                entry, size = decode_entry(data)
+                if entry is not None:
+                    count_entry(entry)
+                    results[index] = (True, use_entry(keys[index], entry, size, calls[index], {}))
+
+        misses = len([found for found, _ in results if not found])
+        if misses:
+            metrics.CACHE_REQUESTS.inc(misses, function=func.__qualname__, result="miss")
 
+        return results
+
+    async def write_many(calls_values: list):
+        """
+        Stores values for many calls with one redis round trip
+        calls_values - list of (args tuple (self included), value)
+        """
+
+        items = []
+        for args, data in calls_values:
+            expire = negative_ttl if data is None else ttl + stale_ttl
+            if expire <= 0:
+                continue
+
+            cache_key = make_cache_key(func, args, {})
+            entry = {"stored_at": time.time(), "value": data}
+            dump, size = codec.encode_sized(entry)
+            remember(cache_key, entry, size)
+            items.append((cache_key, dump, expire))
+
+        if client and items:
+            await set_many_to_cache(items)
+            async with await client.pipeline(transaction=False) as pipe:
+                for cache_key, *_ in items:
+                    await pipe.publish(INVALIDATION_CHANNEL, f"{PROCESS_ID}:{cache_key}")
+                await pipe.execute()
+
+    wrapper.read_many = read_many
+    wrapper.write_many = write_many
     return wrapper
+
+
+def reset_reference_cache():
+    """ Forgets in-process results of reference_cache functions, redis values are kept """
+
+    for memo in reference_memos:
+        memo.clear()
+
+
+def reference_cache(ttl: int, refresh_after: int):
+    """
+    Cache for slow-changing reference data
+
+    Concurrent and repeated calls with the same arguments share one result for the whole run,
+    values are stored in redis for `ttl` seconds,
+    values older than `refresh_after` seconds are returned at once and refreshed in background
+    """
+
+    def decorator(func):
+        cached = cache(func, ttl=refresh_after, stale_ttl=ttl - refresh_after)
+        memo = {}
+        reference_memos.append(memo)
+
+        @wraps(func)
+        async def wrapper(*args, **kwargs):
+            cache_key = make_cache_key(func, args, kwargs)
+
+            task = memo.get(cache_key)
+            if task is None:
+                task = asyncio.ensure_future(cached(*args, **kwargs))
+                memo[cache_key] = task
+
+            try:
+                return await asyncio.shield(task)
+            except Exception:
+                # Failed requests are not remembered, so the next call tries again
+                if memo.get(cache_key) is task:
+                    del memo[cache_key]
+                raise
+
+        return wrapper
+
+    return decorator
+
+
+def local_cache_stats() -> dict:
+    """ Size and hit/miss/eviction counters of the in-process cache """
+
+    return local_cache.stats()
@@ -0,0 +1,82 @@
+import json
+import zlib
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+class CacheCodec:
+    """
+    Converts cache entries to bytes for redis and back
+
+    Every value starts with a two byte header: codec version and flags.
+    Values are packed with msgpack (json if msgpack is not installed)
+    and compressed with zlib, when they are bigger than compress_threshold
+    """
+
+    VERSION = 1
+    MSGPACK = 0x01
+    COMPRESSED = 0x02
+
+    def __init__(self, compress_threshold: int = 1024, compress_level: int = 6):
+        self.compress_threshold = compress_threshold
+        self.compress_level = compress_level
+
+    def encode(self, value) -> bytes:
+        return self.encode_sized(value)[0]
+
+    def decode(self, data: bytes):
+        """ Raises ValueError if the value can't be decoded """
+
+        return self.decode_sized(data)[0]
+
+    def encode_sized(self, value) -> tuple:
+        """ Returns (encoded value, size of the packed value before compression) """
+
+        flags = 0
+        if msgpack is not None:
+            data = msgpack.packb(value, use_bin_type=True)
+            flags |= self.MSGPACK
+        else:
+            data = json.dumps(value, separators=(",", ":")).encode()
+
+        size = len(data)
+        if self.compress_threshold is not None and size > self.compress_threshold:
+            data = zlib.compress(data, self.compress_level)
+            flags |= self.COMPRESSED
+
+        return bytes([self.VERSION, flags]) + data, size
+
+    def decode_sized(self, data: bytes) -> tuple:
+        """
+        Returns (value, size of the packed value before compression)
+        Raises ValueError if the value can't be decoded
+        """
+
+        if isinstance(data, str):
+            data = data.encode()
+
+        # Values written before the codec are plain json
+        if not data or data[0] != self.VERSION:
+            return json.loads(data), len(data)
+
+        flags = data[1]
+        data = data[2:]
+
+        if flags & self.COMPRESSED:
+            try:
+                data = zlib.decompress(data)
+            except zlib.error as err:
+                raise ValueError(err)
+
+        if flags & self.MSGPACK:
+            if msgpack is None:
+                raise ValueError("Value is packed with msgpack, but msgpack is not installed")
+            try:
+                return msgpack.unpackb(data, raw=False), len(data)
+            except Exception as err:
+                raise ValueError(err)
+
+        return json.loads(data), len(data)
@@ -0,0 +1,115 @@
+from contextlib import asynccontextmanager
+from uuid import uuid4
+import asyncio
+from loguru import logger
+
+from . import caching
+
+
+# Slots of requests, that were not released (worker crashed), are freed after this time
+SLOT_TTL = 120
+
+# How often a worker checks, if a slot of the service became free
+SLOT_POLL_INTERVAL = 0.05
+
+# Takes a slot of the service, if there is a free one and the rate of the service allows a request
+# Returns 0 if the slot is taken, otherwise milliseconds to wait before the next try
+ACQUIRE_SCRIPT = """
+redis.replicate_commands()
+local time = redis.call('TIME')
+local now = tonumber(time[1]) * 1000 + math.floor(tonumber(time[2]) / 1000)
+
+local paused = redis.call('PTTL', KEYS[3])
+if paused > 0 then
+    return paused
+end
+
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', now)
+if redis.call('ZCARD', KEYS[1]) >= tonumber(ARGV[1]) then
+    return -1
+end
+
+local rate = tonumber(ARGV[2])
+local burst = tonumber(ARGV[3])
+local cost = tonumber(ARGV[4])
+local bucket = redis.call('HMGET', KEYS[2], 'tokens', 'updated_at')
+local tokens = tonumber(bucket[1]) or burst
+local updated_at = tonumber(bucket[2]) or now
+tokens = math.min(burst, tokens + (now - updated_at) * rate / 1000)
+
+if tokens < 1 then
+    redis.call('HMSET', KEYS[2], 'tokens', tokens, 'updated_at', now)
+    return math.ceil((1 - tokens) * 1000 / rate)
+end
+
+redis.call('HMSET', KEYS[2], 'tokens', tokens - cost, 'updated_at', now)
+redis.call('PEXPIRE', KEYS[2], 60000)
+redis.call('ZADD', KEYS[1], now + tonumber(ARGV[6]), ARGV[5])
+return 0
+"""
+
+
+class GlobalLimiter:
+    """
+    Concurrency and rate limits of services shared by all workers through redis
+    Limits are the same as in utils.sem_limits and utils.rate_dict, but they are counted for all workers together
+    If redis is not available, local limits of the worker are used
+    """
+
+    def __init__(self, concurrency: dict, rates: dict):
+        self.concurrency = concurrency
+        self.rates = rates
+
+    @asynccontextmanager
+    async def slot(self, service: str, cost: int = 1):
+        token = uuid4().hex
+        acquired = await self.acquire(service, cost, token)
+        try:
+            yield
+        finally:
+            if acquired:
+                await self.release(service, token)
+
+    async def acquire(self, service: str, cost: int, token: str) -> bool:
+        """ Waits for a global slot of the service, False if the local rate limiter was used instead """
+
+        limiter = self.rates[service]
+        while True:
+            try:
+                wait = await caching.client.eval(
+                    ACQUIRE_SCRIPT,
+                    3,
+                    f"service_slots({service})",
+                    f"service_rate({service})",
+                    f"service_pause({service})",
+                    self.concurrency[service],
+                    limiter.rate,
+                    limiter.burst,
+                    cost,
+                    token,
+                    SLOT_TTL * 1000,
+                )
+            except Exception as err:
+                logger.warning(f"Global limits of {service} are not available, local limits are used - {err}")
+                await limiter.acquire(cost)
+                return False
+
+            if wait == 0:
+                return True
+
+            await asyncio.sleep(SLOT_POLL_INTERVAL if wait < 0 else wait / 1000)
+
+    async def release(self, service: str, token: str):
+        try:
+            await caching.client.zrem(f"service_slots({service})", token)
+        except Exception as err:
+            # The slot is freed by its expiration
+            logger.warning(f"Slot of {service} could not be released - {err}")
+
+    async def pause(self, service: str, seconds: float):
+        """ Stops requests of all workers to the service for some time """
+
+        try:
+            await caching.client.set(f"service_pause({service})", 1, px=int(seconds * 1000))
+        except Exception as err:
+            logger.warning(f"Global pause of {service} failed - {err}")
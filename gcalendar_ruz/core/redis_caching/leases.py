@@ -0,0 +1,151 @@
+import asyncio
+import hashlib
+import math
+import os
+import socket
+from loguru import logger
+
+from . import caching
+
+
+WORKERS_KEY = "sync_workers"
+
+# Takes the lease, if it is free or already belongs to the worker, and extends it
+CLAIM_SCRIPT = """
+local owner = redis.call('GET', KEYS[1])
+if owner == false or owner == ARGV[1] then
+    redis.call('SET', KEYS[1], ARGV[1], 'PX', ARGV[2])
+    return 1
+end
+return 0
+"""
+
+# Deletes the lease only if it belongs to the worker
+RELEASE_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+# Registers the worker until its heartbeat expires and returns how many workers are alive
+HEARTBEAT_SCRIPT = """
+redis.replicate_commands()
+local time = redis.call('TIME')
+local now = tonumber(time[1]) * 1000 + math.floor(tonumber(time[2]) / 1000)
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', now)
+redis.call('ZADD', KEYS[1], now + tonumber(ARGV[2]), ARGV[1])
+return redis.call('ZCARD', KEYS[1])
+"""
+
+
+def default_worker_id() -> str:
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+
+class RoomLeases:
+    """
+    Splits rooms between workers, every room is synchronized only by the worker that holds its lease
+    Leases are extended by heartbeats and expire if the worker stops, then other workers claim the rooms.
+    Every worker holds at most its share of rooms, so rooms are spread evenly, when workers come and go
+    """
+
+    def __init__(self, worker_id: str = None, ttl: int = 60):
+        self.worker_id = worker_id or default_worker_id()
+        self.ttl = ttl
+        self.owned = set()
+        self.workers = 1
+        self.heartbeat_task = None
+
+    @staticmethod
+    def lease_key(room_id) -> str:
+        return f"room_lease({room_id})"
+
+    def owns(self, room_id) -> bool:
+        return str(room_id) in self.owned
+
+    async def start(self):
+        await self.beat()
+        self.heartbeat_task = asyncio.ensure_future(self.heartbeat())
+        logger.info(f"Worker {self.worker_id} started, {self.workers} workers alive")
+
+    async def stop(self):
+        if self.heartbeat_task is not None:
+            self.heartbeat_task.cancel()
+            self.heartbeat_task = None
+
+        await self.release(list(self.owned))
+        try:
+            await caching.client.zrem(WORKERS_KEY, self.worker_id)
+        except Exception as err:
+            logger.warning(f"Worker {self.worker_id} could not be unregistered - {err}")
+
+    async def claim(self, room_ids: list) -> list:
+        """ Claims the share of rooms for the worker, returns ids of rooms that belong to it now """
+
+        room_ids = [str(room_id) for room_id in room_ids]
+        share = math.ceil(len(room_ids) / max(self.workers, 1))
+
+        # Every worker tries rooms in its own order, so workers don't compete for the same rooms
+        order = sorted(
+            room_ids, key=lambda room_id: hashlib.md5(f"{self.worker_id}:{room_id}".encode()).hexdigest()
+        )
+        kept = [room_id for room_id in order if room_id in self.owned]
+        excess = kept[share:]
+        owned = set(kept[:share])
+
+        for room_id in order:
+            if len(owned) >= share:
+                break
+            if room_id not in owned and await self.extend(room_id):
+                owned.add(room_id)
+
+        # Rooms that disappeared from RUZ or don't fit the share anymore are left to other workers
+        await self.release(excess + [room_id for room_id in self.owned if room_id not in room_ids])
+        self.owned = owned
+
+        logger.info(f"Worker {self.worker_id} holds {len(owned)} of {len(room_ids)} rooms")
+        return [room_id for room_id in room_ids if room_id in owned]
+
+    async def extend(self, room_id: str) -> bool:
+        try:
+            return bool(
+                await caching.client.eval(
+                    CLAIM_SCRIPT, 1, self.lease_key(room_id), self.worker_id, self.ttl * 1000
+                )
+            )
+        except Exception as err:
+            logger.warning(f"Lease of room {room_id} could not be claimed - {err}")
+            return False
+
+    async def release(self, room_ids: list):
+        for room_id in room_ids:
+            self.owned.discard(room_id)
+            try:
+                await caching.client.eval(RELEASE_SCRIPT, 1, self.lease_key(room_id), self.worker_id)
+            except Exception as err:
+                # The lease is freed by its expiration
+                logger.warning(f"Lease of room {room_id} could not be released - {err}")
+
+    async def beat(self):
+        self.workers = await caching.client.eval(
+            HEARTBEAT_SCRIPT, 1, WORKERS_KEY, self.worker_id, self.ttl * 1000
+        )
+
+    async def heartbeat(self):
+        """ Extends the registration of the worker and its leases, leases taken by others are dropped """
+
+        while True:
+            await asyncio.sleep(self.ttl / 3)
+            try:
+                await self.beat()
+                owned = list(self.owned)
+                extended = await asyncio.gather(*[self.extend(room_id) for room_id in owned])
+                lost = [room_id for room_id, ok in zip(owned, extended) if not ok]
+                if lost:
+                    logger.warning(f"Worker {self.worker_id} lost leases of rooms {lost}")
+                    self.owned.difference_update(lost)
+            except asyncio.CancelledError:
+                raise
+            except Exception as err:
+                logger.error(f"Heartbeat of worker {self.worker_id} failed - {err}")
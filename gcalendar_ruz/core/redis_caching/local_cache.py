@@ -0,0 +1,99 @@
+from collections import OrderedDict
+import time
+
+
+class LocalCache:
+    """
+    In-process LRU cache of decoded redis entries
+    Size of an entry is the length of its packed value before compression (decoded objects take
+    a few times more memory), when total size is over max_bytes the least recently used entries are evicted
+    Disabled cache is empty and doesn't keep anything
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.size = 0
+        self.enabled = True
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+    def get(self, key: str):
+        """ Returns entry if it is still fresh, otherwise None """
+
+        if not self.enabled:
+            return None
+
+        item = self.entries.get(key)
+        if item is None:
+            self.misses += 1
+            return None
+
+        entry, size, expires_at = item
+        if time.time() >= expires_at:
+            self.remove(key)
+            self.expirations += 1
+            self.misses += 1
+            return None
+
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry
+
+    def set(self, key: str, entry: dict, size: int, expires_at: float):
+        if not self.enabled:
+            return
+
+        if size > self.max_bytes or time.time() >= expires_at:
+            self.remove(key)
+            return
+
+        self.remove(key)
+        self.entries[key] = (entry, size, expires_at)
+        self.size += size
+
+        while self.size > self.max_bytes:
+            _, (_, evicted_size, _) = self.entries.popitem(last=False)
+            self.size -= evicted_size
+            self.evictions += 1
+
+    def invalidate(self, key: str):
+        if self.remove(key):
+            self.invalidations += 1
+
+    def remove(self, key: str) -> bool:
+        item = self.entries.pop(key, None)
+        if item is None:
+            return False
+        self.size -= item[1]
+        return True
+
+    def clear(self):
+        self.entries.clear()
+        self.size = 0
+
+    def disable(self):
+        self.enabled = False
+        self.clear()
+
+    def enable(self):
+        self.enabled = True
+
+    def stats(self) -> dict:
+        requests = self.hits + self.misses
+        return {
+            "enabled": self.enabled,
+            "entries": len(self.entries),
+            "size_bytes": self.size,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / requests if requests else 0.0,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+            "invalidations": self.invalidations,
+        }
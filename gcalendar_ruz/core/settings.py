@@ -4,11 +4,38 @@ from typing import Optional
 
 class Settings(BaseSettings):
     nvr_api_key: str = Field(..., env="NVR_API_KEY")
+    nvr_api_url: str = Field("https://nvr.miem.hse.ru/api/erudite", env="NVR_API_URL")
+    ruz_api_url: str = Field("http://92.242.58.221/ruzservice.svc", env="RUZ_API_URL")
+    google_api_url: str = Field("https://www.googleapis.com", env="GOOGLE_API_URL")
     db_url: str = Field(..., env="DB_URL")
+    db_pool_size: int = Field(5, env="DB_POOL_SIZE")
+    db_max_overflow: int = Field(5, env="DB_MAX_OVERFLOW")
+    db_pool_recycle: int = Field(1800, env="DB_POOL_RECYCLE")
     url_redis: str = Field(..., env="URL_REDIS")
     period: int = Field(..., env="PERIOD")
+    sync_interval: int = Field(900, env="SYNC_INTERVAL")
+    metrics_port: int = Field(9100, env="METRICS_PORT")
+    sync_horizons: str = Field("1:900,7:3600,period:21600", env="SYNC_HORIZONS")
+    worker_id: Optional[str] = Field(None, env="WORKER_ID")
+    shard_lease_ttl: int = Field(60, env="SHARD_LEASE_TTL")
     creds_path: str = Field(..., env="CREDS_PATH")
     token_path: str = Field(..., env="TOKEN_PATH")
+    google_batch_size: int = Field(50, env="GOOGLE_BATCH_SIZE")
+    google_batch_delay: float = Field(0.1, env="GOOGLE_BATCH_DELAY")
+    ruz_bulk_fetch: bool = Field(True, env="RUZ_BULK_FETCH")
+    # building id МИЭМа = 92
+    ruz_building_id: int = Field(92, env="RUZ_BUILDING_ID")
+    apply_concurrency: int = Field(50, env="APPLY_CONCURRENCY")
+    retry_max_attempts: int = Field(4, env="RETRY_MAX_ATTEMPTS")
+    retry_base_delay: float = Field(0.5, env="RETRY_BASE_DELAY")
+    retry_max_delay: float = Field(30, env="RETRY_MAX_DELAY")
+    retry_budget_ratio: float = Field(0.2, env="RETRY_BUDGET_RATIO")
+    breaker_threshold: int = Field(5, env="BREAKER_THRESHOLD")
+    breaker_reset_timeout: float = Field(15, env="BREAKER_RESET_TIMEOUT")
+    google_quota_pause: int = Field(3600, env="GOOGLE_QUOTA_PAUSE")
+    max_writes: Optional[int] = Field(None, env="MAX_WRITES")
+    cache_compress_threshold: int = Field(1024, env="CACHE_COMPRESS_THRESHOLD")
+    local_cache_max_bytes: int = Field(64 * 1024 * 1024, env="LOCAL_CACHE_MAX_BYTES")
 
     class Config:
         env_file = ".env"
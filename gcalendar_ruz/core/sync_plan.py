@@ -0,0 +1,91 @@
+from datetime import datetime
+import json
+import math
+
+from .settings import settings
+from .utils import GOOGLE, NVR
+
+
+class SyncPlan:
+    """
+    Everything a run is going to write, computed before anything is written
+
+    Every room of the plan is a dict:
+        room_id, room_name
+        add - lessons from RUZ, that are not in Erudite
+        update - {"lesson", "lesson_id", "event_id"} for lessons that differ from Erudite
+        same - {"lesson", "lesson_id", "event_id"} for lessons that are the same, only the sync state is saved
+        delete - lessons from Erudite, that are not in RUZ anymore
+        duplicates - extra copies of lessons in Erudite
+        stale - sync states of lessons, that are not in RUZ anymore
+    The plan consists of json types only, so it can be saved and reviewed
+    """
+
+    def __init__(self, horizon: str = None):
+        self.horizon = horizon
+        self.created_at = datetime.now().isoformat(timespec="seconds")
+        self.rooms = []
+
+    def add_room(self, room_id: str, room_name: str, reconciled: dict, stale: list):
+        """ Adds the room from the result of Nvr_Api.reconcile_room """
+
+        def checked(items: list) -> list:
+            return [
+                {"lesson": lesson, "lesson_id": check_data[1], "event_id": check_data[2]}
+                for lesson, check_data in items
+            ]
+
+        self.rooms.append(
+            {
+                "room_id": str(room_id),
+                "room_name": room_name,
+                "add": [lesson for lesson, _ in reconciled["add"]],
+                "update": checked(reconciled["update"]),
+                "same": checked(reconciled["same"]),
+                "delete": reconciled["delete"],
+                "duplicates": reconciled["duplicates"],
+                "stale": stale,
+            }
+        )
+
+    def count(self, key: str) -> int:
+        return sum(len(room[key]) for room in self.rooms)
+
+    def estimate(self) -> dict:
+        """ Requests the plan needs: calls of every service and http requests to Google (calls are batched) """
+
+        events_deleted = sum(
+            1 for room in self.rooms for lesson in room["delete"] if lesson.get("gcalendar_event_id")
+        )
+        google_calls = self.count("add") + self.count("update") + events_deleted
+        return {
+            # Added lesson is posted and then updated with its event
+            NVR: 2 * self.count("add") + self.count("update") + self.count("delete") + self.count("duplicates"),
+            GOOGLE: google_calls,
+            f"{GOOGLE}_batches": math.ceil(google_calls / settings.google_batch_size),
+        }
+
+    def writes(self) -> int:
+        return sum(
+            count for service, count in self.estimate().items() if service != f"{GOOGLE}_batches"
+        )
+
+    def summary(self) -> str:
+        estimate = ", ".join(f"{service}: {count}" for service, count in self.estimate().items())
+        return (
+            f"Plan for {len(self.rooms)} rooms: {self.count('add')} to add, {self.count('update')} to update, "
+            f"{self.count('same')} same, {self.count('delete')} to delete, {self.count('duplicates')} copies, "
+            f"{self.count('stale')} stale; requests - {estimate}"
+        )
+
+    def to_dict(self) -> dict:
+        return {
+            "horizon": self.horizon,
+            "created_at": self.created_at,
+            "estimate": self.estimate(),
+            "rooms": self.rooms,
+        }
+
+    def save(self, path: str):
+        with open(path, "w", encoding="utf-8") as file:
+            json.dump(self.to_dict(), file, ensure_ascii=False, indent=2)
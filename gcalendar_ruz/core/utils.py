@@ -1,85 +1,463 @@
 import re
+import json
+import hashlib
 from functools import wraps
+from contextlib import asynccontextmanager
 import asyncio
+from collections import deque
+from email.utils import parsedate_to_datetime
+from datetime import datetime, timezone
 from loguru import logger
+import random
 import time
-import sys
+
+from . import metrics
+from .settings import settings
 
 
 GOOGLE = "google"
 NVR = "nvr"
 RUZ = "ruz"
 
+
+class RateLimiter:
+    """
+    Token bucket that paces requests to a service without blocking the event loop
+    rate - requests per second, burst - how many requests can be sent at once after idling
+    """
+
+    def __init__(self, rate: float, burst: int = 1):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated_at = time.monotonic()
+        self.paused_until = 0.0
+        self.lock = asyncio.Lock()
+
+    async def acquire(self, cost: int = 1):
+        """
+        Waits until a request can be sent
+        Cost can be bigger than burst (batch requests), then following requests wait for it to be paid off
+        """
+
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    await asyncio.sleep(self.paused_until - now)
+                    continue
+
+                self.tokens = min(
+                    self.burst, self.tokens + (now - self.updated_at) * self.rate
+                )
+                self.updated_at = now
+                if self.tokens >= 1:
+                    self.tokens -= cost
+                    return
+
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def pause(self, seconds: float):
+        """ Stops all requests to the service for some time, used when the service says we are too fast """
+
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+        self.tokens = 0
+
+
+class AdaptiveLimiter:
+    """
+    Semaphore, which size follows the health of the service (AIMD):
+    while responses are fast and successful, the limit grows by one per `limit` responses,
+    on 429/5xx, failed requests and latency spikes it is multiplied by `backoff`, once per latency window.
+    Latency spike - short-term average latency is `tolerance` times bigger than the long-term one
+    """
+
+    SHORT_ALPHA = 0.2
+    LONG_ALPHA = 0.02
+    # Latency averages are not trusted before this many responses
+    WARMUP = 20
+
+    def __init__(
+        self,
+        service: str,
+        initial: int,
+        min_limit: int,
+        max_limit: int,
+        backoff: float = 0.7,
+        tolerance: float = 2.0,
+    ):
+        self.service = service
+        self.limit = float(initial)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.backoff = backoff
+        self.tolerance = tolerance
+
+        self.inflight = 0
+        self.waiters = deque()
+        self.responses = 0
+        self.short_latency = None
+        self.long_latency = None
+        self.decreased_at = 0.0
+        self.publish()
+
+    async def __aenter__(self):
+        await self.acquire()
+
+    async def __aexit__(self, *exc_info):
+        self.release()
+
+    async def acquire(self):
+        while self.inflight >= int(self.limit):
+            future = asyncio.get_running_loop().create_future()
+            self.waiters.append(future)
+            try:
+                await future
+            except asyncio.CancelledError:
+                if future in self.waiters:
+                    self.waiters.remove(future)
+                else:
+                    # The place given to this waiter goes to the next one
+                    self.wake()
+                raise
+        self.inflight += 1
+
+    def release(self):
+        self.inflight -= 1
+        self.wake()
+
+    def wake(self):
+        free = int(self.limit) - self.inflight
+        while free > 0 and self.waiters:
+            future = self.waiters.popleft()
+            if not future.done():
+                future.set_result(None)
+                free -= 1
+
+    def observe(self, latency: float, status: int = None):
+        """ Result of a request to the service, status is None if the request failed without a response """
+
+        self.responses += 1
+        if self.short_latency is None:
+            self.short_latency = self.long_latency = latency
+        else:
+            self.short_latency += self.SHORT_ALPHA * (latency - self.short_latency)
+            self.long_latency += self.LONG_ALPHA * (latency - self.long_latency)
+
+        overloaded = status is None or status == 429 or status >= 500
+        spike = self.responses > self.WARMUP and self.short_latency > self.tolerance * self.long_latency
+        if overloaded or spike:
+            self.decrease()
+        elif self.inflight >= int(self.limit) - 1:
+            # Only a limit, that is reached, has to grow
+            self.set_limit(self.limit + 1 / self.limit)
+
+    def decrease(self):
+        """ Backs off, errors of requests sent at the same time count as one """
+
+        now = time.monotonic()
+        if now - self.decreased_at < (self.short_latency or 0):
+            return
+
+        self.decreased_at = now
+        self.set_limit(self.limit * self.backoff)
+        logger.info(f"Concurrency limit of {self.service} decreased to {int(self.limit)}")
+
+    def set_limit(self, limit: float):
+        grew = int(limit) > int(self.limit)
+        self.limit = min(self.max_limit, max(self.min_limit, limit))
+        self.publish()
+        if grew:
+            self.wake()
+
+    def publish(self):
+        metrics.CONCURRENCY_LIMIT.set(int(self.limit), service=self.service)
+
+    def stats(self) -> dict:
+        return {"limit": int(self.limit), "inflight": self.inflight, "waiting": len(self.waiters)}
+
+
+# How many requests to each service can be sent at the same time at start,
+# limits adapt between the bounds (min, max) of concurrency_bounds
+sem_limits = {
+    NVR: 100,
+    GOOGLE: 5,
+    RUZ: 10,
+}
+
+concurrency_bounds = {
+    NVR: (10, 150),
+    GOOGLE: (2, 20),
+    RUZ: (2, 20),
+}
+
 sem_dict = {
-    NVR: asyncio.Semaphore(100),
-    GOOGLE: asyncio.Semaphore(5),
-    RUZ: asyncio.Semaphore(10),
+    service: AdaptiveLimiter(service, limit, *concurrency_bounds[service])
+    for service, limit in sem_limits.items()
+}
+
+# Requests per second and burst size for each service
+rate_dict = {
+    NVR: RateLimiter(50, 50),
+    GOOGLE: RateLimiter(10, 10),
+    RUZ: RateLimiter(10, 10),
 }
 
+# Limits shared by all workers (sharded mode), set by set_global_limiter
+global_limiter = None
+
+
+class RetryBudget:
+    """
+    Limits retries to a part of all requests, so retries don't multiply the load on a failing service
+    Every request adds `ratio` of a retry to the budget, every retry takes one, budget starts with `reserve` retries
+    """
+
+    def __init__(self, ratio: float = 0.2, reserve: int = 10):
+        self.ratio = ratio
+        self.reserve = reserve
+        self.balance = float(reserve)
+
+    def deposit(self):
+        self.balance = min(self.balance + self.ratio, self.reserve + 100 * self.ratio)
+
+    def withdraw(self) -> bool:
+        if self.balance < 1:
+            return False
+        self.balance -= 1
+        return True
+
+
+class CircuitOpenError(Exception):
+    """ Service failed too many times and it is not requested for a while """
+
+
+class CircuitBreaker:
+    """
+    Stops traffic to a service after `threshold` failures in a row
+    While the circuit is open requests wait for it (or fail at once, if it is open longer than max_wait),
+    then one request checks the service: on success the circuit is closed, on failure it opens for twice as long
+    """
+
+    PROBE_POLL_INTERVAL = 0.1
+
+    def __init__(
+        self,
+        service: str,
+        threshold: int = 5,
+        reset_timeout: float = 15,
+        max_timeout: float = 300,
+        max_wait: float = 60,
+    ):
+        self.service = service
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.max_timeout = max_timeout
+        self.max_wait = max_wait
+
+        self.failures = 0
+        self.timeout = reset_timeout
+        self.open_until = None
+        self.probing = False
+
+    async def wait(self) -> bool:
+        """
+        Waits until a request can be sent, raises CircuitOpenError if the wait would be too long
+        Returns True if the request is the probe, that checks if the service is back
+        """
+
+        while self.open_until is not None:
+            wait = self.open_until - time.monotonic()
+            if wait > self.max_wait:
+                raise CircuitOpenError(f"{self.service} is unavailable for {wait:.0f} seconds more")
+            if wait > 0:
+                await asyncio.sleep(wait)
+                continue
+            if not self.probing:
+                self.probing = True
+                return True
+            await asyncio.sleep(self.PROBE_POLL_INTERVAL)
+
+        return False
+
+    def success(self):
+        if self.open_until is not None:
+            logger.info(f"Circuit of {self.service} closed, the service is back")
+        self.failures = 0
+        self.timeout = self.reset_timeout
+        self.open_until = None
+        self.probing = False
+
+    def failure(self):
+        self.failures += 1
+        if self.probing:
+            self.probing = False
+            self.timeout = min(self.timeout * 2, self.max_timeout)
+            self.trip(self.timeout)
+        elif self.open_until is None and self.failures >= self.threshold:
+            self.trip(self.timeout)
+
+    def abort(self, probe: bool):
+        """ Request was cancelled or failed on the client side, so it tells nothing about the service """
+
+        if probe:
+            self.probing = False
+
+    def trip(self, seconds: float):
+        self.open_until = time.monotonic() + seconds
+        metrics.CIRCUIT_OPENS.inc(service=self.service)
+        logger.error(f"Circuit of {self.service} opened for {seconds:.0f} seconds")
+
+
+# Statuses after which a request can be repeated; only after 429 and 503 the request was surely not processed,
+# so requests that are not idempotent are repeated only after them
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+NOT_PROCESSED_STATUSES = {429, 503}
+
+retry_budgets = {service: RetryBudget(settings.retry_budget_ratio) for service in sem_limits}
+
+breakers = {
+    service: CircuitBreaker(service, settings.breaker_threshold, settings.breaker_reset_timeout)
+    for service in sem_limits
+}
+
+
+def backoff_delay(attempt: int) -> float:
+    """ Exponential backoff with full jitter, attempt counts from 0 """
+
+    return random.uniform(0, min(settings.retry_max_delay, settings.retry_base_delay * 2 ** attempt))
+
+
+def parse_retry_after(value: str):
+    """ Seconds from the Retry-After header (seconds or HTTP date), None if there is no valid value """
+
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+
+def set_global_limiter(limiter):
+    """ Makes limits of sem_dict and rate_dict global for all workers, None returns to local limits """
+
+    global global_limiter
+    global_limiter = limiter
+
+
+def concurrency_limits() -> dict:
+    """ Current limit, requests in flight and waiting requests of every service """
+
+    return {service: sem.stats() for service, sem in sem_dict.items()}
+
+
+async def pause_service(service: str, seconds: float):
+    """ Stops requests to the service for some time, in all workers if limits are global """
+
+    rate_dict[service].pause(seconds)
+    sem_dict[service].decrease()
+    if global_limiter is not None:
+        await global_limiter.pause(service, seconds)
+
 
 def camel_to_snake(name):
     name = re.sub("(.)([A-Z][a-z]+)", r"\1_\2", name)
     return re.sub("([a-z0-9])([A-Z])", r"\1_\2", name).lower()
 
 
-def semlock(func):
-    @wraps(func)
-    async def wrapper(self, *args, **kwargs):
-        service = self.SERVICE
-        sem = sem_dict.get(service)
-        if not sem:
-            logger.error("Unsupported service")
+@asynccontextmanager
+async def service_slot(service: str, cost: int = 1):
+    """ Takes a place in the service semaphore and waits for the service rate limit """
 
-        async with sem:
-            return await func(self, *args, **kwargs)
+    sem = sem_dict.get(service)
+    limiter = rate_dict.get(service)
+    if not sem or not limiter:
+        logger.error("Unsupported service")
 
-    return wrapper
+    waiting_since = time.monotonic()
+    async with sem:
+        if global_limiter is None:
+            await limiter.acquire(cost)
+            metrics.SLOT_WAIT.observe(time.monotonic() - waiting_since, service=service)
+            yield
+        else:
+            async with global_limiter.slot(service, cost):
+                metrics.SLOT_WAIT.observe(time.monotonic() - waiting_since, service=service)
+                yield
 
 
-def token_check(func):
-    @wraps(func)
-    async def wrapper(self, *args, **kwargs):
-        if not self.creds or self.creds.expired:
-            logger.info("Refresh google tokens")
-            self.refresh_token()
+def lesson_fingerprint(lesson: dict) -> str:
+    """ Stable hash of the lesson data, ids of the lesson in Google Calendar are not included """
+
+    data = {
+        key: value
+        for key, value in lesson.items()
+        if key not in ("gcalendar_event_id", "gcalendar_calendar_id")
+    }
+    dump = json.dumps(data, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(dump.encode()).hexdigest()
 
-        self.HEADERS = {
-            "Content-Type": "application/json",
-            "Authorization": f"Bearer {self.creds.token}",
-        }
 
-        return await func(self, *args, **kwargs)
+def semlock(func):
+    @wraps(func)
+    async def wrapper(self, *args, **kwargs):
+        async with service_slot(self.SERVICE):
+            started_at = time.monotonic()
+            try:
+                return await func(self, *args, **kwargs)
+            finally:
+                metrics.CALL_LATENCY.observe(
+                    time.monotonic() - started_at, service=self.SERVICE, operation=func.__name__
+                )
 
     return wrapper
 
 
 def handle_google_errors(func):
+    """
+    Repeats calls limited by Google with backoff, while there are attempts and retry budget left
+    Exceeded daily quota opens the circuit of Google, so following calls fail at once
+    Errors are returned to the caller as the result ({"error": ...})
+    """
+
     @wraps(func)
     async def wrapper(self, *args, **kwargs):
-        result = await func(self, *args, **kwargs)
-        try:
-            error = result["error"]
-        except Exception:
-            error = None
-            return result
-
-        if error:
+        attempt = 0
+        while True:
+            result = await func(self, *args, **kwargs)
+            try:
+                error = result["error"]
+            except Exception:
+                return result
+
+            if not error:
+                return result
+
             try:
                 error_reason = error["errors"][0]["reason"]
             except Exception:
                 error_reason = None
 
-            if error_reason == "rateLimitExceeded":
+            if error_reason in ("rateLimitExceeded", "userRateLimitExceeded"):
                 logger.error("Rate limit for google exceeded")
-                time.sleep(11)
-                return await wrapper(self, *args, **kwargs)
-            elif error_reason == "quotaExceeded":
+                attempt += 1
+                if attempt >= settings.retry_max_attempts or not retry_budgets[GOOGLE].withdraw():
+                    logger.error("Retries for google are exhausted")
+                    return result
+
+                metrics.RETRIES.inc(service=GOOGLE, reason=error_reason)
+                await pause_service(GOOGLE, backoff_delay(attempt))
+            elif error_reason in ("quotaExceeded", "dailyLimitExceeded"):
                 logger.error("Usage limit for google exceeded")
-                sys.exit(1)
+                breakers[GOOGLE].trip(settings.google_quota_pause)
+                return result
             else:
                 logger.error(f"Other reason  -  {result}")
-
-        else:
-            return result
+                return result
 
     return wrapper
@@ -1,69 +1,240 @@
 from datetime import datetime, timedelta
+import argparse
 import asyncio
-from loguru import logger
+import os
+import signal
 import time
+from loguru import logger
+
+from core.context import AppContext, app
+from core.redis_caching.caching import redis_connect, reset_reference_cache
+from core.redis_caching.leases import RoomLeases
+from core.redis_caching.global_limits import GlobalLimiter
+from core.gmail import alert_async, get_gmail
+from core.db.sync_state import SyncStateStore
+from core.db.lookup import LookupIndex
+from core.settings import settings
+from core import metrics
+from core.horizons import Horizon, HorizonScheduler, parse_horizons
+from core.sync_plan import SyncPlan
+from core.utils import sem_limits, rate_dict, set_global_limiter
+
 
-from core.apis.ruz_api import RuzApi
-from core.apis.calendar_api import GCalendar
-from core.db.models import Session, Room, OnlineRoom, Record, UserRecord, User
-from core.apis.nvr_api import Nvr_Api
-from core.redis_caching.caching import redis_connect
-from core.gmail import alert_async
+# How many events are deleted at the same time during purge
+PURGE_CHUNK = 500
+# Purge stops after this many listings of the calendar, even if some events are left
+PURGE_MAX_PASSES = 10
+
+# Daemon sends an alert, when this many cycles in a row failed
+ALERT_AFTER_FAILURES = 3
 
 
 class CalendarManager:
-    def __init__(self):
-        self.session = Session()
-        self.ruz_api = RuzApi()
-        self.nvr_api = Nvr_Api()
-        self.calendar_api = GCalendar()
+    def __init__(
+        self,
+        leases: RoomLeases = None,
+        dry_run: bool = False,
+        plan_file: str = None,
+        max_writes: int = settings.max_writes,
+        context: AppContext = app,
+    ):
+        # Clients are shared through the context, it closes them
+        self.db = context.db
+        self.ruz_api = context.ruz_api
+        self.nvr_api = context.nvr_api
+        self.calendar_api = context.calendar
 
-        self.ruz = self.session.query(OnlineRoom).filter_by(name="РУЗ").first()
-        self.jitsi = self.session.query(OnlineRoom).filter_by(name="Jitsi").first()
+        self.ruz = None
+        self.jitsi = None
 
-    def __del__(self):
-        self.session.close()
+        self.sync_state = SyncStateStore(self.db)
+        self.index = LookupIndex(self.db)
 
-    async def get_rooms(self):
-        offline_rooms = [room.name for room in self.session.query(Room).all()]
+        # Sharded mode: only rooms leased by this worker are synchronized
+        self.leases = leases
+
+        # Dry run only plans, plans bigger than max_writes are not applied
+        self.dry_run = dry_run
+        self.plan_file = plan_file
+        self.max_writes = max_writes
+
+        self.cycle_lock = asyncio.Lock()
+        self.scheduler = HorizonScheduler(parse_horizons(settings.sync_horizons, self.ruz_api.period))
+
+    async def run_cycle(self):
+        """
+        One synchronization of all rooms, state that depends on the date is recomputed every time
+        Only horizons, which interval has passed, are synchronized, nearest horizons first
+        """
+
+        if self.cycle_lock.locked():
+            logger.warning("Previous cycle is still running, this one is skipped")
+            return
+
+        async with self.cycle_lock:
+            before = metrics.snapshot()
+            self.nvr_api.refresh_date()
+            self.ruz_api.nvr_api.refresh_date()
+            reset_reference_cache()
+
+            started_at = time.monotonic()
+            for horizon in self.scheduler.due(started_at):
+                logger.info(f"Synchronizing horizon {horizon.name}")
+                await self.get_rooms(horizon)
+                self.scheduler.mark_done(horizon, started_at)
+
+            metrics.log_summary(before)
+
+    async def load_index(self):
+        """ Loads rooms, users and online rooms, can be called again to see changes in the database """
+
+        await self.index.refresh()
+        self.ruz = self.index.online_room("РУЗ")
+        self.jitsi = self.index.online_room("Jitsi")
+
+    async def get_rooms(self, horizon: Horizon = None) -> SyncPlan:
+        """
+        Synchronizes lessons of all rooms, for the horizon only or for the whole period
+        Everything is planned first, then the plan is applied, unless it is a dry run or the plan is too big
+        """
+
+        from_day, to_day = (horizon.from_day, horizon.to_day) if horizon else (0, self.ruz_api.period)
+
+        plan = await self.plan_rooms(horizon)
+        logger.info(plan.summary())
+        if self.plan_file:
+            # Every horizon gets its own file
+            root, ext = os.path.splitext(self.plan_file)
+            path = f"{root}-{from_day}-{to_day}{ext}" if horizon else self.plan_file
+            plan.save(path)
+            logger.info(f"Plan saved to {path}")
+
+        if self.dry_run:
+            logger.info("Dry run, nothing is written")
+            return plan
+
+        if self.max_writes is not None and plan.writes() > self.max_writes:
+            logger.error(
+                f"Plan needs {plan.writes()} writes, only {self.max_writes} are allowed, nothing is written"
+            )
+            return plan
+
+        await self.apply_plan(plan)
+
+        today = datetime.today().date()
+        logger.info(f"Created events for {today + timedelta(days=from_day)} - {today + timedelta(days=to_day)}")
+        return plan
+
+    async def plan_rooms(self, horizon: Horizon = None) -> SyncPlan:
+        """ Reads RUZ, Erudite and the sync state and decides what has to be written, nothing is changed """
+
+        await self.load_index()
+        await self.sync_state.load()
 
         rooms = await self.ruz_api.get_auditoriumoid()
+        if self.leases is not None:
+            owned = set(await self.leases.claim([room["auditoriumOid"] for room in rooms]))
+            rooms = [room for room in rooms if str(room["auditoriumOid"]) in owned]
+
+        # Lessons of the whole period are needed even for a horizon: a lesson can move between horizons
+        lessons_by_room = await self.ruz_api.get_lessons_in_rooms([room["auditoriumOid"] for room in rooms])
 
+        plan = SyncPlan(horizon.name if horizon else None)
         tasks = [
-            self.synchronize_lessons_in_room(room["auditoriumOid"], offline_rooms, room["number"])
+            self.plan_room(
+                plan,
+                room["auditoriumOid"],
+                room["number"],
+                lessons_by_room[str(room["auditoriumOid"])],
+                horizon,
+            )
             for room in rooms
         ]
 
         await asyncio.gather(*tasks)
+        return plan
 
-        logger.info(
-            f"Created events for {datetime.today().date() + timedelta(days=1)} - {datetime.today().date() + timedelta(days=self.ruz_api.period)}"
-        )
+    async def plan_room(
+        self, plan: SyncPlan, room_id: str, room_name: str, lessons: list = None, horizon: Horizon = None
+    ):
+        """
+        Adds changes of the room to the plan
+        lessons - lessons of the room for the whole period, only lessons of the horizon are written,
+        but lessons, that RUZ still has anywhere in the period, are never deleted
+        """
+
+        if lessons is None:
+            lessons = await self.get_lessons_from_room(room_id)
+        if not lessons:
+            return
+
+        period_lessons = lessons
+        dates = horizon.dates() if horizon else None
+        if dates is not None:
+            lessons = [lesson for lesson in lessons if dates[0] <= lesson["date"] <= dates[1]]
 
-    async def synchronize_lessons_in_room(self, room_id: str, offline_rooms: list, room_name: str):
-        lessons = await self.get_lessons_from_room(room_id)
+        # If no lesson changed since the last run, the room is not checked in Erudite at all
+        changed = [lesson for lesson in lessons if not self.sync_state.is_unchanged(lesson)]
+        stale = self.sync_state.stale_in_room(room_id, period_lessons, dates)
+        if not changed and not stale:
+            logger.info(f"Room {room_name}: nothing changed since the last run")
+            return
 
-        if lessons:
-            logger.info(
-                f"""
-                Successfully got lessons for room {room_name}
-                Synchronizing lessons in calendar and Erudite
-                """
+        # Everything reconcile found is written, also lessons deleted or edited in Erudite outside of the module
+        period_oids = {lesson["ruz_lesson_oid"] for lesson in period_lessons}
+        reconciled = await self.nvr_api.reconcile_room(lessons, room_id, dates, period_oids)
+        plan.add_room(room_id, room_name, reconciled, stale)
+
+    async def apply_plan(self, plan: SyncPlan):
+        """
+        Writes the plan, lessons of all rooms share one limit of concurrent writes (settings.apply_concurrency)
+        In every room lessons are deleted first, then lessons are updated and added, nearest lessons first
+        """
+
+        offline_rooms = set(self.index.rooms_by_name)
+        sem = asyncio.Semaphore(settings.apply_concurrency)
+        await asyncio.gather(*[self.apply_room(room, offline_rooms, sem) for room in plan.rooms])
+
+    async def apply_room(self, room: dict, offline_rooms: set, sem: asyncio.Semaphore):
+        room_id = room["room_id"]
+        if self.leases is not None and not self.leases.owns(room_id):
+            logger.warning(f"Room {room['room_name']}: lease was lost, the room is left to another worker")
+            return
+
+        # Deletes lessons from Erudite if it doesn't exist in Ruz
+        failed = await self.nvr_api.delete_erudite_lessons(room["delete"])
+        await self.nvr_api.delete_duplicates(room["duplicates"])
+
+        not_deleted = {lesson_erudite["ruz_lesson_oid"] for lesson_erudite, _ in failed}
+        deleted = [lesson_erudite["ruz_lesson_oid"] for lesson_erudite in room["delete"]]
+        deleted += [state["ruz_lesson_oid"] for state in room["stale"]]
+        self.sync_state.remove([oid for oid in deleted if oid not in not_deleted])
+
+        for item in room["same"]:
+            self.sync_state.save(
+                item["lesson"], item["lesson_id"], item["event_id"], self.calendar_for_lesson(item["lesson"])
             )
-            # Deletes lessons from Erudite if it doesn't exist in Ruz
-            await self.nvr_api.check_delete_Erudite_lessons(lessons, room_id)
-            time.sleep(0.2)
 
-            for i in range(0, len(lessons), 10):
-                chunk = lessons[i : i + 10]
+        async def write(lesson: dict, item: dict = None):
+            async with sem:
+                try:
+                    if item is None:
+                        await self.add_lesson(lesson, offline_rooms)
+                    else:
+                        await self.update_lesson(lesson, offline_rooms, item["lesson_id"], item["event_id"])
+                except Exception as err:
+                    # Sync state of the lesson is not saved, so it is written again by the next run
+                    logger.error(f"Lesson {lesson['ruz_lesson_oid']} of room {room['room_name']} failed - {err}")
+
+        writes = [(item["lesson"], item) for item in room["update"]] + [(lesson, None) for lesson in room["add"]]
+        writes.sort(key=lambda write: (write[0]["date"], write[0]["start_time"]))
+        await asyncio.gather(*[write(lesson, item) for lesson, item in writes])
 
-                tasks = [
-                    self.synchronize_lesson(room_id, lesson, offline_rooms) for lesson in chunk
-                ]
-                await asyncio.gather(*tasks)
+        await self.sync_state.commit()
+        await self.db.flush_records()
 
     async def get_lessons_from_room(self, room_id: str) -> list:
-        """ Get lessons in room from ruz """
+        """ Get lessons in room from ruz for the whole period """
 
         try:
             lessons = await self.ruz_api.get_lessons(room_id)
@@ -73,29 +244,18 @@ class CalendarManager:
 
         return lessons
 
-    async def synchronize_lesson(
-        self,
-        room_id: str,
-        lesson: dict,
-        offline_rooms: list,
-    ):
-        check_data = await self.nvr_api.check_lesson(lesson)
-        status = check_data[0]
-
-        # Lesson not found in Erudite, so we add it
-        if status == "Not found":
-            await self.add_lesson(lesson, offline_rooms)
+    def calendar_for_lesson(self, lesson: dict) -> str:
+        """ Jitsi lessons are kept in the Jitsi calendar, all others - in the RUZ calendar """
 
-        # Lesson found in Erudite, but the data of this lesson has to be updated
-        elif status == "Update":
-            lesson_id = check_data[1]
-            event_id = check_data[2]
-            await self.update_lesson(lesson, offline_rooms, lesson_id, event_id)
-            time.sleep(0.6)
+        if lesson["ruz_url"] is not None and "meet.miem.hse.ru" in lesson["ruz_url"]:
+            return self.jitsi.calendar
+        return self.ruz.calendar
 
     async def add_lesson(self, lesson: dict, offline_rooms: list):
         """ Adds lesson to Erudite and Google Calendar """
 
+        lesson = dict(lesson)  # lessons from the cache are shared, so they are not changed
+
         if lesson["ruz_url"] is None or "meet.miem.hse.ru" not in lesson["ruz_url"]:
             logger.info("Adding ruz lesson")
             data = await self.test_post_lesson(lesson)
@@ -105,13 +265,11 @@ class CalendarManager:
             if code == 201 or code == 409:
                 try:
                     event = await self.post_lesson(lesson, erudite_lesson["id"], self.ruz.calendar)
-                    time.sleep(0.6)
                 except:
                     logger.warning(f"Erudite returned - {erudite_lesson}")
 
             if lesson["ruz_auditorium"] in offline_rooms and event:
-                room = self.session.query(Room).filter_by(name=lesson["ruz_auditorium"]).first()
-                self.create_record(room, event)
+                self.create_record(lesson["ruz_auditorium"], event)
 
         elif lesson["ruz_url"] is not None and "meet.miem.hse.ru" in lesson["ruz_url"]:
             logger.info("Adding jitsi lesson")
@@ -129,29 +287,43 @@ class CalendarManager:
     async def update_lesson(self, lesson: dict, offline_rooms: list, lesson_id: str, event_id: str):
         """ Updates lesson in Erudite and Google Calendar """
 
+        lesson = dict(lesson)  # lessons from the cache are shared, so they are not changed
+
         if lesson["ruz_url"] is None or "meet.miem.hse.ru" not in lesson["ruz_url"]:
             logger.info("Updating ruz lesson")
             try:
-                event = await self.calendar_api.update_event(self.ruz.calendar, event_id, lesson)
+                event = await self.write_event(self.ruz.calendar, event_id, lesson)
                 lesson["gcalendar_event_id"] = event["id"]
                 lesson["gcalendar_calendar_id"] = self.ruz.calendar
             except:
                 logger.warning("Lesson could not be updated succesfully in calendar")
-            await self.nvr_api.update_lesson(lesson_id, lesson)
+            updated = await self.nvr_api.update_lesson(lesson_id, lesson)
+            # State is saved only if both writes succeeded, otherwise the lesson is written again by the next run
+            if updated and lesson.get("gcalendar_event_id"):
+                self.sync_state.save(lesson, lesson_id, lesson["gcalendar_event_id"], self.ruz.calendar)
 
             # if lesson["ruz_auditorium"] in offline_rooms:
-            #     room = self.session.query(Room).filter_by(name=lesson["ruz_auditorium"]).first()
-            #     self.create_record(room, event)
+            #     self.create_record(lesson["ruz_auditorium"], event)
 
         elif lesson["ruz_url"] is not None and "meet.miem.hse.ru" in lesson["ruz_url"]:
             logger.info("Updating jitsi lesson")
             try:
-                event = await self.calendar_api.update_event(self.jitsi.calendar, event_id, lesson)
+                event = await self.write_event(self.jitsi.calendar, event_id, lesson)
                 lesson["gcalendar_event_id"] = event["id"]
                 lesson["gcalendar_calendar_id"] = self.jitsi.calendar
             except:
                 logger.warning("Lesson could not be updated succesfully in calendar")
-            await self.nvr_api.update_lesson(lesson_id, lesson)
+            updated = await self.nvr_api.update_lesson(lesson_id, lesson)
+            # State is saved only if both writes succeeded, otherwise the lesson is written again by the next run
+            if updated and lesson.get("gcalendar_event_id"):
+                self.sync_state.save(lesson, lesson_id, lesson["gcalendar_event_id"], self.jitsi.calendar)
+
+    async def write_event(self, calendar_id: str, event_id: str, lesson: dict) -> dict:
+        """ Updates the event of the lesson, the event is created if the lesson has none (cleared by purge) """
+
+        if event_id:
+            return await self.calendar_api.update_event(calendar_id, event_id, lesson, batched=True)
+        return await self.calendar_api.create_event(calendar_id, lesson, batched=True)
 
     async def test_post_lesson(self, lesson: dict):
         """ Post a lesson with empty event_id """
@@ -168,61 +340,216 @@ class CalendarManager:
     async def post_lesson(self, lesson: dict, lesson_id: str, calendar_id: str):
         """ Posts event to Google calendar and updates lesson in Erudite """
 
-        event = await self.calendar_api.create_event(self.ruz.calendar, lesson)
+        event = await self.calendar_api.create_event(self.ruz.calendar, lesson, batched=True)
         lesson["gcalendar_event_id"] = event["id"]
         lesson["gcalendar_calendar_id"] = calendar_id
-        await self.nvr_api.update_lesson(lesson_id, lesson)
+        if await self.nvr_api.update_lesson(lesson_id, lesson):
+            self.sync_state.save(lesson, lesson_id, event["id"], calendar_id)
 
         return event
 
-    def create_record(self, room: Room, event: dict):
-        start_date = event["start"]["dateTime"].split("T")[0]
-        end_date = event["end"]["dateTime"].split("T")[0]
+    def create_record(self, room_name: str, event: dict):
+        """ Adds record of the event to the next database flush, if its creator is a user """
 
-        if start_date != end_date:
+        room = self.index.room(room_name)
+        creator = self.index.user(event["creator"]["email"])
+        if not room or not creator:
             return
 
-        creator = self.session.query(User).filter_by(email=event["creator"]["email"]).first()
-        if not creator:
-            return
+        self.db.add_record(room.id, creator.id, event)
+
+    async def delete_online_events(self, clear_erudite: bool = False):
+        """
+        Deletes all upcoming events from the Jitsi and RUZ calendars, both calendars are purged concurrently
+        Deleting is idempotent, so an interrupted purge is resumed by running it again
+        """
 
-        new_record = Record()
-        new_record.room = room
-        new_record.update_from_calendar(**event)
-        self.session.add(new_record)
-        self.session.commit()
+        await self.load_index()
+        calendars = [self.jitsi.calendar, self.ruz.calendar]
+        await asyncio.gather(*[self.purge_calendar(calendar_id) for calendar_id in calendars])
 
-        user_record = UserRecord(user_id=creator.id, record_id=new_record.id)
-        self.session.add(user_record)
-        self.session.commit()
+        # Lessons with deleted events have to be synchronized again on the next run
+        await self.sync_state.load()
+        self.sync_state.remove_calendars(calendars)
+        await self.sync_state.commit()
 
-    async def delete_online_events(self):
-        while True:
-            events = await self.calendar_api.get_events(self.jitsi.calendar)
+        if clear_erudite:
+            rooms = await self.ruz_api.get_auditoriumoid()
+            lessons = await asyncio.gather(
+                *[self.nvr_api.get_lessons_in_room(room["auditoriumOid"]) for room in rooms]
+            )
+            lessons = [
+                lesson
+                for room_lessons in lessons
+                for lesson in room_lessons
+                if lesson.get("gcalendar_calendar_id") in calendars and lesson.get("gcalendar_event_id")
+            ]
+            await self.nvr_api.clear_event_ids(lessons)
+
+    async def purge_calendar(self, calendar_id: str):
+        deleted = 0
+        for _ in range(PURGE_MAX_PASSES):
+            events = await self.calendar_api.get_events(calendar_id, fields="items(id),nextPageToken")
             if len(events) == 0:
                 break
-            for event in events:
-                await self.calendar_api.delete_event(self.jitsi.calendar, event["id"])
 
-        while True:
-            events = await self.calendar_api.get_events(self.ruz.calendar)
-            if len(events) == 0:
+            failed = 0
+            for i in range(0, len(events), PURGE_CHUNK):
+                chunk = events[i : i + PURGE_CHUNK]
+                results = await asyncio.gather(
+                    *[self.calendar_api.delete_event(calendar_id, event["id"], batched=True) for event in chunk],
+                    return_exceptions=True,
+                )
+                chunk_failed = len([result for result in results if result is not None])
+                failed += chunk_failed
+                deleted += len(chunk) - chunk_failed
+                logger.info(f"Calendar {calendar_id}: {deleted} events deleted, {len(events) - i - len(chunk)} left")
+
+            if failed == len(events):
+                logger.error(f"Calendar {calendar_id}: no events could be deleted, purge stopped")
                 break
-            for event in events:
-                await self.calendar_api.delete_event(self.ruz.calendar, event["id"])
+        else:
+            logger.error(f"Calendar {calendar_id}: events are left after {PURGE_MAX_PASSES} passes, purge stopped")
+
+        logger.info(f"Calendar {calendar_id} purged, {deleted} events deleted")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Synchronizes lessons from RUZ with Erudite and Google Calendar")
+    parser.add_argument("--mode", choices=["sync", "purge", "daemon"], default="sync")
+    parser.add_argument(
+        "--clear-erudite",
+        action="store_true",
+        help="purge mode: also clear references to deleted events in Erudite, so the next sync creates them again",
+    )
+    parser.add_argument(
+        "--sharded",
+        action="store_true",
+        help="sync and daemon modes: split rooms with other workers through redis leases, limits are global",
+    )
+    parser.add_argument(
+        "--interval",
+        type=int,
+        default=settings.sync_interval,
+        help="daemon mode: seconds between starts of synchronization cycles",
+    )
+    parser.add_argument(
+        "--metrics-port",
+        type=int,
+        default=settings.metrics_port,
+        help="daemon mode: port of the prometheus /metrics endpoint, 0 disables it",
+    )
+    parser.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="sync and daemon modes: only plan the changes and log how many requests they need",
+    )
+    parser.add_argument("--plan-file", help="save plans to this json file, every horizon to its own file")
+    parser.add_argument(
+        "--max-writes",
+        type=int,
+        default=settings.max_writes,
+        help="plans that need more write requests are not applied",
+    )
+    return parser.parse_args()
+
+
+async def run_daemon(manager: CalendarManager, interval: int, metrics_port: int = 0):
+    """ Runs synchronization cycles until SIGINT or SIGTERM, the running cycle is finished before exit """
+
+    loop = asyncio.get_running_loop()
+    stop = asyncio.Event()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    metrics_runner = await metrics.serve(metrics_port) if metrics_port else None
+
+    logger.info(f"Daemon started, synchronization every {interval} seconds")
+    failures = 0
+    while not stop.is_set():
+        started_at = loop.time()
+        try:
+            await manager.run_cycle()
+            failures = 0
+        except Exception as error:
+            logger.exception("Synchronization cycle failed")
+            failures += 1
+            # One alert for every streak of failed cycles, sending the email blocks, so it is done in a thread
+            if failures == ALERT_AFTER_FAILURES:
+                gmail = get_gmail()
+                message = gmail.create_message(f"{failures} synchronization cycles in a row failed, last - {error}")
+                try:
+                    await loop.run_in_executor(None, gmail.send_gmail_to_myself, message)
+                except Exception as err:
+                    logger.error(f"Alert could not be sent - {err}")
+
+        # Next cycle starts `interval` seconds after the start of the previous one, or at once if it took longer
+        wait = max(0, interval - (loop.time() - started_at))
+        try:
+            await asyncio.wait_for(stop.wait(), timeout=wait)
+        except asyncio.TimeoutError:
+            pass
+
+    if metrics_runner is not None:
+        await metrics_runner.cleanup()
+    logger.info("Daemon stopped")
 
 
 @logger.catch
 @alert_async
-async def main():
-    await redis_connect()
-    manager = CalendarManager()
+async def main(
+    mode: str = "sync",
+    clear_erudite: bool = False,
+    interval: int = settings.sync_interval,
+    sharded: bool = False,
+    metrics_port: int = settings.metrics_port,
+    dry_run: bool = False,
+    plan_file: str = None,
+    max_writes: int = settings.max_writes,
+):
+    redis = await redis_connect()
+
+    leases = None
+    if sharded and mode != "purge":
+        if redis is None:
+            logger.error("Sharded mode needs redis")
+            return
 
-    await manager.get_rooms()
+        leases = RoomLeases(settings.worker_id, settings.shard_lease_ttl)
+        await leases.start()
+        set_global_limiter(GlobalLimiter(sem_limits, rate_dict))
+
+    manager = CalendarManager(leases, dry_run, plan_file, max_writes)
+
+    try:
+        await manager.sync_state.create_table()
+        if mode == "purge":
+            await manager.delete_online_events(clear_erudite)
+            metrics.log_summary()
+        elif mode == "daemon":
+            await run_daemon(manager, interval, metrics_port)
+        else:
+            await manager.run_cycle()
+    finally:
+        if leases is not None:
+            await leases.stop()
+        await app.close()
 
     logger.info("Finished!!!")
 
 
 if __name__ == "__main__":
+    args = parse_args()
     loop = asyncio.get_event_loop()
-    loop.run_until_complete(main())
+    loop.run_until_complete(
+        main(
+            args.mode,
+            args.clear_erudite,
+            args.interval,
+            args.sharded,
+            args.metrics_port,
+            args.dry_run,
+            args.plan_file,
+            args.max_writes,
+        )
+    )
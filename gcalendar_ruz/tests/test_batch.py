@@ -0,0 +1,82 @@
+from core.apis.calendar_api import build_batch_body, parse_batch_response
+
+
+BOUNDARY = "batch_test"
+
+
+def response_part(index: int, status: str, body: str = "") -> str:
+    return (
+        f"--{BOUNDARY}\r\n"
+        "Content-Type: application/http\r\n"
+        f"Content-ID: <response-item{index}>\r\n\r\n"
+        f"HTTP/1.1 {status}\r\n"
+        "Content-Type: application/json; charset=UTF-8\r\n\r\n"
+        f"{body}\r\n"
+    )
+
+
+def test_build_batch_body():
+    items = [
+        ("POST", "/calendars/room/events", {"summary": "Lesson"}, None),
+        ("DELETE", "/calendars/room/events/abc", None, None),
+    ]
+
+    body = build_batch_body(items, BOUNDARY)
+
+    assert body == (
+        f"--{BOUNDARY}\r\n"
+        "Content-Type: application/http\r\n"
+        "Content-ID: <item0>\r\n\r\n"
+        "POST /calendar/v3/calendars/room/events HTTP/1.1\r\n"
+        "Content-Type: application/json\r\n\r\n"
+        '{"summary": "Lesson"}\r\n'
+        f"--{BOUNDARY}\r\n"
+        "Content-Type: application/http\r\n"
+        "Content-ID: <item1>\r\n\r\n"
+        "DELETE /calendar/v3/calendars/room/events/abc HTTP/1.1\r\n\r\n"
+        f"--{BOUNDARY}--\r\n"
+    )
+
+
+def test_parse_batch_response():
+    text = (
+        response_part(1, "200 OK", '{"id": "second"}')
+        + response_part(0, "200 OK", '{"id": "first"}')
+        + response_part(2, "204 No Content")
+        + f"--{BOUNDARY}--\r\n"
+    )
+
+    assert parse_batch_response(text, BOUNDARY) == {
+        0: {"id": "first"},
+        1: {"id": "second"},
+        2: None,
+    }
+
+
+def test_parse_batch_response_errors():
+    error = '{"error": {"code": 403, "errors": [{"reason": "rateLimitExceeded"}]}}'
+    text = (
+        response_part(0, "403 Forbidden", error)
+        + response_part(1, "404 Not Found")
+        + response_part(2, "410 Gone", '{"kind": "calendar#event"}')
+        + f"--{BOUNDARY}--\r\n"
+    )
+
+    results = parse_batch_response(text, BOUNDARY)
+
+    assert results[0]["error"]["errors"][0]["reason"] == "rateLimitExceeded"
+    assert results[1] == {"error": {"code": 404, "errors": []}}
+    assert results[2] == {"error": {"code": 410, "errors": []}}
+
+
+def test_parse_batch_response_skips_parts_without_content_id():
+    text = (
+        f"--{BOUNDARY}\r\n"
+        "Content-Type: application/http\r\n\r\n"
+        "HTTP/1.1 200 OK\r\n\r\n"
+        "{}\r\n"
+        + response_part(0, "200 OK", '{"id": "first"}')
+        + f"--{BOUNDARY}--"
+    )
+
+    assert parse_batch_response(text, BOUNDARY) == {0: {"id": "first"}}
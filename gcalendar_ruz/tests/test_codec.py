@@ -0,0 +1,58 @@
+import json
+
+import pytest
+
+from core.redis_caching.codec import CacheCodec
+
+
+VALUE = {"room": "504", "lessons": [{"summary": "Lesson", "date": "2021-09-01"}] * 100}
+
+
+def test_round_trip():
+    codec = CacheCodec()
+
+    assert codec.decode(codec.encode(VALUE)) == VALUE
+    assert codec.decode(codec.encode(None)) is None
+
+
+def test_compression_threshold():
+    codec = CacheCodec(compress_threshold=1024)
+
+    small = codec.encode({"room": "504"})
+    big = codec.encode(VALUE)
+
+    assert small[0] == CacheCodec.VERSION and not small[1] & CacheCodec.COMPRESSED
+    assert big[0] == CacheCodec.VERSION and big[1] & CacheCodec.COMPRESSED
+    assert codec.decode(big) == VALUE
+
+
+def test_no_compression():
+    data = CacheCodec(compress_threshold=None).encode(VALUE)
+
+    assert not data[1] & CacheCodec.COMPRESSED
+
+
+def test_sizes_before_compression():
+    codec = CacheCodec(compress_threshold=1024)
+
+    data, size = codec.encode_sized(VALUE)
+    value, decoded_size = codec.decode_sized(data)
+
+    assert value == VALUE
+    assert size == decoded_size
+    assert size > len(data)
+
+
+def test_plain_json():
+    data = json.dumps(VALUE)
+
+    assert CacheCodec().decode(data) == VALUE
+    assert CacheCodec().decode_sized(data.encode()) == (VALUE, len(data))
+
+
+def test_broken_value():
+    codec = CacheCodec(compress_threshold=1024)
+    data = codec.encode(VALUE)
+
+    with pytest.raises(ValueError):
+        codec.decode(data[:2] + b"broken")
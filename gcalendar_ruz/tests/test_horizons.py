@@ -0,0 +1,55 @@
+from datetime import datetime, timedelta
+
+from core.horizons import Horizon, HorizonScheduler, parse_horizons, SCHEDULE_SLACK
+
+
+def test_parse_horizons():
+    assert parse_horizons("1:900,7:3600,period:21600", 14) == [
+        Horizon("days 0-1", 0, 1, 900),
+        Horizon("days 2-7", 2, 7, 3600),
+        Horizon("days 8-14", 8, 14, 21600),
+    ]
+
+
+def test_parse_horizons_cut_by_period():
+    assert parse_horizons("1:900,7:3600,30:21600", 5) == [
+        Horizon("days 0-1", 0, 1, 900),
+        Horizon("days 2-5", 2, 5, 3600),
+    ]
+
+
+def test_parse_horizons_rest_of_period():
+    assert parse_horizons("1:900, 7:3600", 14) == [
+        Horizon("days 0-1", 0, 1, 900),
+        Horizon("days 2-7", 2, 7, 3600),
+        Horizon("days 8-14", 8, 14, 3600),
+    ]
+
+
+def test_horizon_dates():
+    today = datetime.today()
+
+    assert Horizon("days 2-7", 2, 7, 3600).dates() == (
+        (today + timedelta(days=2)).strftime("%Y-%m-%d"),
+        (today + timedelta(days=7)).strftime("%Y-%m-%d"),
+    )
+
+
+def test_scheduler():
+    near, far = Horizon("days 0-1", 0, 1, 900), Horizon("days 2-14", 2, 14, 3600)
+    scheduler = HorizonScheduler([far, near])
+
+    # Nothing was synchronized yet, nearest horizons come first
+    assert scheduler.due(0) == [near, far]
+
+    scheduler.mark_done(near, 0)
+    scheduler.mark_done(far, 0)
+    assert scheduler.due(100) == []
+
+    # Timers can fire a bit earlier than the interval ends
+    assert scheduler.due(900 - SCHEDULE_SLACK) == [near]
+    assert scheduler.due(900 - SCHEDULE_SLACK - 0.5) == []
+
+    scheduler.mark_done(near, 900)
+    assert scheduler.due(1000) == []
+    assert scheduler.due(3600) == [near, far]
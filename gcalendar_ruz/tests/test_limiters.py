@@ -0,0 +1,138 @@
+import asyncio
+
+import pytest
+
+from core.utils import AdaptiveLimiter, RateLimiter
+
+
+def test_rate_limiter_burst(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr("core.utils.time.monotonic", lambda: now[0])
+
+    async def run():
+        limiter = RateLimiter(rate=10, burst=3)
+        for _ in range(3):
+            await limiter.acquire()
+        return limiter
+
+    limiter = asyncio.run(run())
+
+    assert limiter.tokens == pytest.approx(0)
+
+
+def test_rate_limiter_refill_is_capped_by_burst(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr("core.utils.time.monotonic", lambda: now[0])
+
+    async def run():
+        limiter = RateLimiter(rate=10, burst=3)
+        await limiter.acquire(3)
+        now[0] += 10
+        await limiter.acquire()
+        return limiter
+
+    limiter = asyncio.run(run())
+
+    assert limiter.tokens == pytest.approx(2)
+
+
+def test_rate_limiter_cost_bigger_than_burst():
+    async def run():
+        limiter = RateLimiter(rate=100, burst=2)
+        await limiter.acquire(5)
+        debt = limiter.tokens
+
+        started_at = asyncio.get_running_loop().time()
+        await limiter.acquire()
+        return debt, asyncio.get_running_loop().time() - started_at
+
+    debt, waited = asyncio.run(run())
+
+    assert debt == pytest.approx(-3)
+    # The debt of 3 requests and one more request are paid off at 100 requests per second
+    assert waited >= 0.03
+
+
+def test_rate_limiter_pause():
+    limiter = RateLimiter(rate=10, burst=3)
+    limiter.pause(5)
+
+    assert limiter.tokens == 0
+    assert limiter.paused_until > limiter.updated_at
+
+
+def test_adaptive_limiter_accounting():
+    async def run():
+        limiter = AdaptiveLimiter("test", initial=2, min_limit=1, max_limit=10)
+        entered = []
+
+        async def request(index):
+            async with limiter:
+                entered.append(index)
+                await asyncio.sleep(0.01)
+
+        tasks = [asyncio.ensure_future(request(index)) for index in range(5)]
+        await asyncio.sleep(0)
+        during = limiter.stats()
+        await asyncio.gather(*tasks)
+        return during, limiter.stats(), entered
+
+    during, after, entered = asyncio.run(run())
+
+    assert during == {"limit": 2, "inflight": 2, "waiting": 3}
+    assert after == {"limit": 2, "inflight": 0, "waiting": 0}
+    assert sorted(entered) == list(range(5))
+
+
+def test_adaptive_limiter_cancelled_waiter():
+    async def run():
+        limiter = AdaptiveLimiter("test", initial=1, min_limit=1, max_limit=10)
+        await limiter.acquire()
+
+        waiter = asyncio.ensure_future(limiter.acquire())
+        other = asyncio.ensure_future(limiter.acquire())
+        await asyncio.sleep(0)
+        waiter.cancel()
+        await asyncio.sleep(0)
+
+        limiter.release()
+        await other
+        return limiter.stats()
+
+    assert asyncio.run(run()) == {"limit": 1, "inflight": 1, "waiting": 0}
+
+
+def test_adaptive_limiter_decrease(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr("core.utils.time.monotonic", lambda: now[0])
+    limiter = AdaptiveLimiter("test", initial=10, min_limit=2, max_limit=20)
+
+    limiter.observe(0.5, 503)
+    assert limiter.stats()["limit"] == 7
+
+    # Errors of requests sent at the same time count as one
+    limiter.observe(0.5, 429)
+    assert limiter.stats()["limit"] == 7
+
+    now[0] += 1
+    limiter.observe(0.5, None)
+    assert limiter.stats()["limit"] == 4
+
+    for _ in range(5):
+        now[0] += 1
+        limiter.observe(0.5, 500)
+    assert limiter.stats()["limit"] == 2
+
+
+def test_adaptive_limiter_growth():
+    limiter = AdaptiveLimiter("test", initial=2, min_limit=1, max_limit=3)
+
+    # Limit, that is not reached, doesn't grow
+    for _ in range(10):
+        limiter.observe(0.1, 200)
+    assert limiter.stats()["limit"] == 2
+
+    limiter.inflight = 2
+    for _ in range(10):
+        limiter.observe(0.1, 200)
+    assert limiter.stats()["limit"] == 3
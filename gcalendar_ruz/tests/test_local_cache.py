@@ -0,0 +1,99 @@
+import time
+
+from core.redis_caching.local_cache import LocalCache
+
+
+def expires_in(seconds: float) -> float:
+    return time.time() + seconds
+
+
+def test_get_and_set():
+    cache = LocalCache(100)
+
+    assert cache.get("a") is None
+    cache.set("a", {"value": 1}, 10, expires_in(60))
+
+    assert cache.get("a") == {"value": 1}
+    assert cache.stats()["hits"] == 1
+    assert cache.stats()["misses"] == 1
+    assert cache.stats()["hit_ratio"] == 0.5
+
+
+def test_replace_keeps_size():
+    cache = LocalCache(100)
+
+    cache.set("a", {"value": 1}, 10, expires_in(60))
+    cache.set("a", {"value": 2}, 30, expires_in(60))
+
+    assert cache.get("a") == {"value": 2}
+    assert cache.size == 30
+    assert len(cache.entries) == 1
+
+
+def test_lru_eviction():
+    cache = LocalCache(100)
+
+    cache.set("a", {"value": 1}, 40, expires_in(60))
+    cache.set("b", {"value": 2}, 40, expires_in(60))
+    # "a" becomes the most recently used one
+    cache.get("a")
+    cache.set("c", {"value": 3}, 40, expires_in(60))
+
+    assert cache.get("b") is None
+    assert cache.get("a") == {"value": 1}
+    assert cache.get("c") == {"value": 3}
+    assert cache.size == 80
+    assert cache.stats()["evictions"] == 1
+
+
+def test_too_big_entry():
+    cache = LocalCache(100)
+
+    cache.set("a", {"value": 1}, 10, expires_in(60))
+    cache.set("a", {"value": 2}, 101, expires_in(60))
+
+    assert cache.get("a") is None
+    assert cache.size == 0
+
+
+def test_expiration():
+    cache = LocalCache(100)
+
+    cache.set("a", {"value": 1}, 10, expires_in(60))
+    cache.entries["a"] = ({"value": 1}, 10, time.time() - 1)
+
+    assert cache.get("a") is None
+    assert cache.size == 0
+    assert cache.stats()["expirations"] == 1
+
+    cache.set("b", {"value": 2}, 10, time.time() - 1)
+    assert "b" not in cache.entries
+
+
+def test_invalidate():
+    cache = LocalCache(100)
+
+    cache.set("a", {"value": 1}, 10, expires_in(60))
+    cache.invalidate("a")
+    cache.invalidate("missing")
+
+    assert cache.get("a") is None
+    assert cache.size == 0
+    assert cache.stats()["invalidations"] == 1
+
+
+def test_disable():
+    cache = LocalCache(100)
+
+    cache.set("a", {"value": 1}, 10, expires_in(60))
+    cache.disable()
+    cache.set("b", {"value": 2}, 10, expires_in(60))
+
+    assert cache.get("a") is None
+    assert cache.get("b") is None
+    assert cache.stats()["enabled"] is False
+    assert cache.stats()["entries"] == 0
+
+    cache.enable()
+    cache.set("b", {"value": 2}, 10, expires_in(60))
+    assert cache.get("b") == {"value": 2}